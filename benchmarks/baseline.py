@@ -0,0 +1,63 @@
+from jinja2 import Environment
+
+from octoprint_gcode_macro import FORBIDDEN_MACROS
+
+
+class BaselineRenderer:
+    """
+    How macros were rendered before they were compiled & cached: parsed with from_string on every call, split
+    & stripped with a lambda, and sub-macros rendered by recursion. Kept to compare the plugin against.
+    """
+
+    def __init__(self, macros):
+        """
+        :param macros: dict, command -> content
+        """
+        self.macros = macros
+        self.jinja_env = Environment()
+
+    def gcode_queueing(
+        self,
+        c,
+        p,
+        command,
+        ct,
+        g,
+        subcode=None,
+        tags=None,
+        *args,
+        **kwargs,
+    ):
+        if command.startswith("@"):
+            return self.render_macro(command)
+
+    def render_macro(self, command, level=0):
+        command = command.strip("@")
+
+        if command in FORBIDDEN_MACROS or command not in self.macros.keys():
+            return
+
+        content = self.render_with_jinja(command)
+
+        if content and isinstance(content, str):
+            commands = content.split("\n")
+            commands = list(map(lambda x: x.split(";")[0].strip(), commands))
+
+            result = []
+
+            if level <= 4:
+                for cmd in commands:
+                    if cmd.startswith("@"):
+                        submacro = self.render_macro(cmd, level=level + 1)
+                        if submacro:
+                            result += submacro
+                    else:
+                        result += [cmd]
+
+            return result
+
+        return
+
+    def render_with_jinja(self, command):
+        template = self.jinja_env.from_string(self.macros[command])
+        return template.render()
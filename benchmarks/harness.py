@@ -0,0 +1,166 @@
+import copy
+import gc
+import logging
+import tempfile
+import time
+
+from octoprint_gcode_macro import GcodeMacroPlugin
+
+
+class Settings:
+    """
+    Stands in for the plugin's settings, as injected by OctoPrint, backed by a dict of the plugin's defaults
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.saved = 0
+
+    def get(self, path, merged=False):
+        value = self.values
+        for key in path:
+            value = value[key]
+        return value
+
+    def get_all_data(self, merged=False):
+        return self.values
+
+    def get_int(self, path):
+        return int(self.get(path))
+
+    def get_float(self, path):
+        return float(self.get(path))
+
+    def get_boolean(self, path):
+        return bool(self.get(path))
+
+    def set(self, path, value):
+        target = self.values
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+
+    def save(self):
+        self.saved += 1
+
+
+class PluginManager:
+    def __init__(self):
+        self.messages = []
+
+    def send_plugin_message(self, plugin, data):
+        self.messages.append(data)
+
+    def get_hooks(self, hook):
+        return {}
+
+
+class Printer:
+    def __init__(self):
+        self.callbacks = []
+
+    def register_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        self.callbacks.remove(callback)
+
+
+def create_plugin(data_folder, **settings):
+    """
+    Create & initialize the plugin the way OctoPrint would, also used by the tests
+    :param data_folder: string, plugin data folder
+    :param settings: overrides of the default settings
+    :return: GcodeMacroPlugin
+    """
+    plugin = GcodeMacroPlugin()
+    plugin._identifier = "gcode_macro"
+    plugin._data_folder = data_folder
+    plugin._logger = logging.getLogger("octoprint.plugins.gcode_macro")
+    plugin._plugin_manager = PluginManager()
+    plugin._printer = Printer()
+    values = copy.deepcopy(plugin.get_settings_defaults())
+    values.update(settings)
+    plugin._settings = Settings(values)
+    plugin.initialize()
+    return plugin
+
+
+def start_plugin(data_folder=None, **settings):
+    """
+    Create the plugin for a benchmark, with macros from an earlier run if there are any. Files aren't watched &
+    macros aren't preloaded unless the settings say so, as neither would be measured.
+    :param data_folder: string, plugin data folder, a new temporary folder if None
+    :param settings: overrides of the default settings
+    :return: GcodeMacroPlugin
+    """
+    return create_plugin(
+        data_folder or tempfile.mkdtemp(prefix="gcode_macro_bench_"),
+        **{"watch_files": False, "preload_threads": 0, **settings},
+    )
+
+
+def make_plugin(macros, data_folder=None, **settings):
+    """
+    Create the plugin the way OctoPrint would & save macros to it
+    :param macros: dict, command -> content, or settings entry with the content & any options
+    :param data_folder: string, plugin data folder, a new temporary folder if None
+    :param settings: overrides of the default settings
+    :return: GcodeMacroPlugin
+    """
+    plugin = start_plugin(data_folder, **settings)
+    plugin.save_macros(
+        [
+            {"command": command, "description": "", **macro}
+            if isinstance(macro, dict)
+            else {"command": command, "description": "", "content": macro}
+            for command, macro in macros.items()
+        ]
+    )
+    return plugin
+
+
+def per_call(function, seconds=1.0, repeat=5):
+    """
+    Time a function, in the fastest of several runs so other load on the machine doesn't count
+    :param function: callable, called without arguments
+    :param seconds: float, roughly how long each run takes
+    :param repeat: int, number of runs
+    :return: float, seconds per call
+    """
+    function()
+    start = time.perf_counter()
+    function()
+    calls = max(1, int(seconds / max(time.perf_counter() - start, 1e-7)))
+
+    best = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(calls):
+                function()
+            best = min(best, (time.perf_counter() - start) / calls)
+    finally:
+        gc.enable()
+    return best
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.1f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def print_table(headings, rows):
+    widths = [
+        max(len(str(row[column])) for row in [headings, *rows])
+        for column in range(len(headings))
+    ]
+    for row in [headings, *rows]:
+        print(
+            "  ".join(
+                str(cell).ljust(widths[column]) for column, cell in enumerate(row)
+            ).rstrip()
+        )
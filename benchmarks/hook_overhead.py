@@ -0,0 +1,74 @@
+"""
+Overhead of the gcode queuing hook on a 1M-line job, which the plugin sees every line of. The job is mostly
+moves, with an @ command that isn't a macro every 1,000 lines, as other plugins use them. A job of nothing but
+@ commands that aren't macros shows the worst case.
+
+    python -m benchmarks.hook_overhead
+"""
+import time
+
+from benchmarks.baseline import BaselineRenderer
+from benchmarks.harness import make_plugin, print_table
+
+LINES = 1_000_000
+
+
+def synthetic_job(at_commands=False):
+    job = []
+    for i in range(LINES):
+        if at_commands or i % 1000 == 999:
+            job.append("@OCTOLAPSE TAKE-SNAPSHOT")
+        elif i % 100 == 0:
+            job.append(f"M106 S{i % 256}")
+        else:
+            job.append(f"G1 X{i % 200}.{i % 10} Y{i % 180}.5 E{i / 1000:.5f}")
+    return job
+
+
+def run_job(hook, job):
+    """
+    :return: float, fastest of 5 runs in seconds, less the time the loop itself takes
+    """
+    best = empty = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in job:
+            pass
+        empty = min(empty, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for line in job:
+            # As OctoPrint's comm layer calls it
+            hook(None, "queuing", line, None, None, subcode=None, tags=None)
+        best = min(best, time.perf_counter() - start)
+    return best - empty
+
+
+def main():
+    macros = {"start": "G28\nG1 Z10", "end": "M104 S0\nM140 S0"}
+    baseline = BaselineRenderer(macros)
+    plugin = make_plugin(macros)
+
+    rows = []
+    for job_name, job in (
+        ("moves", synthetic_job()),
+        ("@ commands", synthetic_job(at_commands=True)),
+    ):
+        for name, hook in (
+            ("before", baseline.gcode_queueing),
+            ("after", plugin.gcode_queueing),
+        ):
+            seconds = run_job(hook, job)
+            rows.append(
+                (
+                    job_name,
+                    name,
+                    f"{seconds * 1000:.0f} ms",
+                    f"{seconds / LINES * 1e9:.0f} ns",
+                )
+            )
+    print_table(("job", "hook", f"{LINES:,} lines", "per line"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Time & peak memory of expanding a tree of macros, each calling the next level down 20 times, 5 levels deep, with
+the old recursive expansion against the plugin's explicit stack. Both have their templates compiled already, so
+this compares expanding the tree rather than parsing it.
+
+    python -m benchmarks.macro_tree
+"""
+import time
+import tracemalloc
+
+from benchmarks.baseline import BaselineRenderer
+from benchmarks.harness import format_time, make_plugin, print_table
+
+FAN_OUT = 20
+DEPTH = 5
+
+
+class RecursiveRenderer(BaselineRenderer):
+    """
+    The old recursive expansion, with each template compiled once
+    """
+
+    def __init__(self, macros):
+        super().__init__(macros)
+        self.templates = {}
+
+    def render_with_jinja(self, command):
+        template = self.templates.get(command)
+        if template is None:
+            template = self.templates[command] = self.jinja_env.from_string(
+                self.macros[command]
+            )
+        return template.render()
+
+
+def macro_tree(templated):
+    """
+    :param templated: bool, whether each macro is a template, otherwise they are plain gcode & can be flattened
+    :return: dict, command -> content, the tree starts at level0
+    """
+    x = "{{ 10 }}" if templated else "10"
+    macros = {}
+    for level in range(DEPTH):
+        content = f"G1 X{x} ; level {level}\n"
+        if level < DEPTH - 1:
+            content += f"@level{level + 1}\n" * FAN_OUT
+        macros[f"level{level}"] = content
+    return macros
+
+
+def measure(render):
+    """
+    :param render: callable, renders the tree
+    :return: tuple of (float, seconds of the fastest of 3 renders; int, peak bytes allocated while rendering)
+    """
+    render()
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        render()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    lines = render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, len(lines)
+
+
+def main():
+    rows = []
+    for templated in (True, False):
+        macros = macro_tree(templated)
+        recursive = RecursiveRenderer(macros)
+        renderers = [("recursive", recursive)]
+        for cache_result in (False, True) if templated else (False,):
+            plugin = make_plugin(
+                {
+                    command: {"content": content, "cache_result": cache_result}
+                    for command, content in macros.items()
+                }
+            )
+            name = "explicit stack" + (", results cached" if cache_result else "")
+            renderers.append((name, plugin))
+
+        expected = recursive.render_macro("@level0")
+        for name, renderer in renderers:
+            assert renderer.render_macro("@level0") == expected
+            seconds, peak, lines = measure(
+                lambda renderer=renderer: renderer.render_macro("@level0")
+            )
+            rows.append(
+                (
+                    "templated" if templated else "static",
+                    name,
+                    lines,
+                    format_time(seconds),
+                    f"{peak / 2**20:.1f} MB",
+                )
+            )
+    print_table(("macros", "expansion", "lines", "time", "peak memory"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Memory kept by compiled macros after rendering each of 5,000 macros once, with no memory budget, the default
+budget & two small ones. Counted is what the plugin counts against the budget, retained is what Python still holds
+after the renders, including Jinja's own template cache.
+
+    python -m benchmarks.memory
+"""
+import gc
+import tracemalloc
+
+from benchmarks.harness import make_plugin, print_table
+
+MACROS = 5000
+LINES = 20
+
+BUDGETS_KB = (0, 8192, 256, 16)
+
+
+def macros():
+    return {
+        f"macro{i}": f"G1 X{{{{ params.X|default({i}) }}}} ; macro {i}\n"
+        + "".join(f"G1 Y{line}\n" for line in range(LINES - 1))
+        for i in range(MACROS)
+    }
+
+
+def main():
+    plugin = make_plugin(macros())
+
+    rows = []
+    for budget in BUDGETS_KB:
+        plugin._settings.set(["macro_memory_kb"], budget)
+        plugin.update_options()
+        plugin.recompile_macros()
+        plugin.jinja_env.cache.clear()
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(MACROS):
+            assert len(plugin.render_macro(f"@macro{i}")) == LINES
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        rows.append(
+            (
+                f"{budget} KB" if budget else "unlimited",
+                len(plugin._compiled),
+                len(plugin.jinja_env.cache),
+                f"{plugin._compiled_bytes / 1024:.0f} KB",
+                f"{retained / 2**20:.1f} MB",
+            )
+        )
+    plugin.on_shutdown()
+    print_table(("budget", "compiled", "jinja cache", "counted", "retained"), rows)
+
+
+if __name__ == "__main__":
+    main()
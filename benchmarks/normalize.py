@@ -0,0 +1,67 @@
+"""
+Turning a 100k-line render into commands, with the single-pass normaliser against the old split & lambda
+pipeline. The old pipeline kept empty lines & parenthesised comments, so it does less work than the normaliser.
+
+    python -m benchmarks.normalize
+"""
+import tracemalloc
+
+from benchmarks.harness import format_time, per_call, print_table
+from octoprint_gcode_macro.gcode import split_commands
+
+LINES = 100_000
+
+
+def lambda_pipeline(content):
+    commands = content.split("\n")
+    return list(map(lambda x: x.split(";")[0].strip(), commands))
+
+
+def purge_pattern(comments):
+    """
+    :param comments: bool, whether to include comments & blank lines, as hand-written macros have, or only commands
+        as generated patterns usually are
+    :return: string, rendered content
+    """
+    lines = []
+    for i in range(LINES):
+        move = f"G1 X{i % 200}.{i % 10} Y{(i * 7) % 180}.5 E{i / 1000:.5f}"
+        if comments and i % 10 == 0:
+            lines.append(f"; line {i} of the purge pattern")
+            lines.append("")
+        if comments and i % 5 == 0:
+            move += " ; extrude"
+        lines.append(move)
+    return "\n".join(lines)
+
+
+def peak_memory(function, content):
+    tracemalloc.start()
+    function(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    rows = []
+    for comments in (False, True):
+        content = purge_pattern(comments)
+        for name, function in (
+            ("split & lambda", lambda_pipeline),
+            ("normalize_gcode", split_commands),
+        ):
+            rows.append(
+                (
+                    "with comments" if comments else "commands only",
+                    name,
+                    len(function(content)),
+                    format_time(per_call(lambda f=function, c=content: f(c), repeat=5)),
+                    f"{peak_memory(function, content) / 2**20:.1f} MB",
+                )
+            )
+    print_table(("content", "normaliser", "lines out", "time", "peak memory"), rows)
+
+
+if __name__ == "__main__":
+    main()
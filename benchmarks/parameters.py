@@ -0,0 +1,106 @@
+"""
+Parsing & rendering a macro called with 10 parameters, against a target of 10k calls a second. Calls either repeat
+the same arguments, as a print start macro does, or have different values every time, as a generated job would.
+
+    python -m benchmarks.parameters
+"""
+import itertools
+
+from benchmarks.harness import format_time, make_plugin, per_call, print_table
+from octoprint_gcode_macro.params import parse_arguments
+
+TARGET = 10_000
+
+PARAMETERS = [
+    {"name": "BED", "type": "int", "default": 60, "min": 0, "max": 120},
+    {"name": "EXTRUDER", "type": "int", "default": 215, "min": 0, "max": 300},
+    {"name": "CHAMBER", "type": "int", "default": 0, "min": 0, "max": 70},
+    {"name": "SPEED", "type": "float", "default": 3000.0, "min": 1},
+    {"name": "Z", "type": "float", "default": 0.3},
+    {"name": "MESH", "type": "bool", "default": False},
+    {"name": "PURGE", "type": "bool", "default": True},
+    {"name": "FILAMENT", "type": "string", "default": "PLA"},
+    {"name": "NOZZLE", "type": "float", "default": 0.4},
+    {"name": "LAYER", "type": "int", "default": 1, "min": 0},
+]
+
+PRINT_START = """M140 S{{ params.BED }}
+M104 S{{ params.EXTRUDER }}
+{% if params.CHAMBER %}M141 S{{ params.CHAMBER }}{% endif %}
+G28
+{% if params.MESH %}G29{% endif %}
+G1 Z{{ params.Z }} F{{ params.SPEED }}
+{% if params.PURGE %}G1 X100 E{{ params.NOZZLE * 20 }}{% endif %}
+M117 {{ params.FILAMENT }} layer {{ params.LAYER }}
+"""
+
+
+def call(i):
+    return (
+        f"@print_start BED={60 + i % 50} EXTRUDER={200 + i % 90} CHAMBER={i % 60} "
+        f"SPEED={1000 + i} Z={i % 10 / 10} MESH={i % 2} PURGE=yes "
+        f'FILAMENT="PETG {i}" NOZZLE=0.6 LAYER={i}'
+    )
+
+
+def main():
+    rows = []
+    for cache_result in (False, True):
+        plugin = make_plugin(
+            {
+                "print_start": {
+                    "content": PRINT_START,
+                    "parameters": PARAMETERS,
+                    "cache_result": cache_result,
+                }
+            }
+        )
+        assert len(plugin.render_macro(call(1))) == 8
+
+        for arguments, calls in (
+            ("same", itertools.repeat(call(1))),
+            ("different", map(call, itertools.count())),
+        ):
+            seconds = per_call(
+                lambda calls=calls, plugin=plugin: plugin.render_macro(next(calls))
+            )
+            rows.append(
+                (
+                    "render_macro",
+                    "on" if cache_result else "off",
+                    arguments,
+                    format_time(seconds),
+                    f"{1 / seconds:,.0f}",
+                    f"{seconds * TARGET:.0%}",
+                )
+            )
+
+    # Parsing on its own, without the cache of recent arguments
+    seconds = per_call(
+        lambda calls=map(call, itertools.count()): parse_arguments(next(calls))
+    )
+    rows.append(
+        (
+            "parse_arguments",
+            "",
+            "different",
+            format_time(seconds),
+            f"{1 / seconds:,.0f}",
+            f"{seconds * TARGET:.0%}",
+        )
+    )
+    print_table(
+        (
+            "calls",
+            "result cache",
+            "arguments",
+            "per call",
+            "calls/s",
+            f"CPU at {TARGET:,}/s",
+        ),
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
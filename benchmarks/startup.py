@@ -0,0 +1,97 @@
+"""
+Startup time with 10, 1,000 & 20,000 macros saved by an earlier run, to show loading the index scales linearly.
+Checking the index against storage straight away is timed as well as preloading in the background, where startup
+only waits for the index & the rest finishes on the loader's threads. The macros are in a temporary folder, usually
+on a fast disk, where checking them is cheaper than it would be on a Raspberry Pi's SD card.
+
+Python's cyclic garbage collector gets slower as the heap grows, so startup is also timed without it to show what
+the plugin's own code costs per macro.
+
+    python -m benchmarks.startup
+"""
+import copy
+import gc
+import time
+
+from benchmarks.harness import format_time, make_plugin, print_table, start_plugin
+
+SIZES = (10, 1000, 20000)
+PRELOAD_THREADS = 4
+
+
+def macros(count):
+    return {
+        f"macro{i}": f"G28\nG1 X{i % 200} Y{i % 180} F3000\n"
+        + (f"M117 {{{{ params.MSG|default({i}) }}}}\n" if i % 10 == 0 else "")
+        for i in range(count)
+    }
+
+
+def restart(data_folder, settings, preload_threads, collect=True):
+    """
+    :param collect: bool, whether the garbage collector runs during startup
+    :return: tuple of (float, seconds until initialize returned; float, seconds until preloading finished)
+    """
+    settings = copy.deepcopy(settings)
+    gc.collect()
+    if not collect:
+        gc.disable()
+    try:
+        start = time.perf_counter()
+        plugin = start_plugin(
+            data_folder, macros=settings, preload_threads=preload_threads
+        )
+        started = time.perf_counter() - start
+        while plugin.macro_loader.loading:
+            time.sleep(0.001)
+        loaded = time.perf_counter() - start
+    finally:
+        gc.enable()
+    assert len(plugin.macros) == len(settings)
+    plugin.on_shutdown()
+    return started, loaded
+
+
+def main():
+    rows = []
+    for count in SIZES:
+        plugin = make_plugin(macros(count))
+        data_folder = plugin._data_folder
+        settings = plugin._settings.get(["macros"])
+        plugin.on_shutdown()
+
+        for name, threads in (
+            ("checked", 0),
+            (f"preloaded, {PRELOAD_THREADS} threads", PRELOAD_THREADS),
+        ):
+            started, loaded = min(
+                restart(data_folder, settings, threads) for _ in range(3)
+            )
+            uncollected, _ = min(
+                restart(data_folder, settings, threads, collect=False) for _ in range(3)
+            )
+            rows.append(
+                (
+                    count,
+                    name,
+                    format_time(started),
+                    format_time(started / count),
+                    format_time(uncollected / count),
+                    format_time(loaded),
+                )
+            )
+    print_table(
+        (
+            "macros",
+            "index",
+            "startup",
+            "per macro",
+            "per macro without gc",
+            "all loaded",
+        ),
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Saving, loading & reading macros with each storage backend: one file per macro, or a single SQLite database.
+Saving all macros is a first save of the whole library, saving one is a settings save from the UI where a single
+macro changed. Loading is startup with the index checked against storage, reading is every macro's content as when
+the settings are opened.
+
+    python -m benchmarks.storage
+"""
+import copy
+import time
+
+from benchmarks.harness import format_time, print_table, start_plugin
+
+SIZES = (100, 2000)
+BACKENDS = ("files", "sqlite")
+
+
+def macros(count, changed=None):
+    """
+    :param changed: int, macro whose content is changed, if any
+    :return: list of macros as saved from the settings
+    """
+    return [
+        {
+            "command": f"macro{i}",
+            "description": "",
+            "content": f"G28\nG1 X{i % 200} Y{i % 180} F3000\n"
+            + ("M117 changed\n" if i == changed else ""),
+        }
+        for i in range(count)
+    ]
+
+
+def timed(function, *args, **kwargs):
+    """
+    :return: tuple of (float, seconds taken; return value of the function)
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def read_all(plugin, count):
+    for i in range(count):
+        plugin.get_macro_content(f"macro{i}")
+
+
+def measure(count, backend):
+    """
+    :return: tuple of seconds to save all macros, save one changed macro, load the macros & read all of them
+    """
+    plugin = start_plugin(storage=backend)
+    save_all, _ = timed(plugin.save_macros, macros(count))
+    save_one = min(
+        timed(plugin.save_macros, macros(count, changed))[0] for changed in range(3)
+    )
+    data_folder = plugin._data_folder
+    settings = plugin._settings.get(["macros"])
+    plugin.on_shutdown()
+
+    load = read = float("inf")
+    for _ in range(3):
+        seconds, plugin = timed(
+            start_plugin, data_folder, storage=backend, macros=copy.deepcopy(settings)
+        )
+        load = min(load, seconds)
+        read = min(read, timed(read_all, plugin, count)[0])
+        plugin.on_shutdown()
+    return save_all, save_one, load, read
+
+
+def main():
+    rows = []
+    for count in SIZES:
+        for backend in BACKENDS:
+            times = measure(count, backend)
+            rows.append((count, backend, *(format_time(seconds) for seconds in times)))
+    print_table(("macros", "storage", "save all", "save one", "load", "read all"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Response time of a web server in OctoPrint's process while a 200k-line macro renders, rendered in the process
+itself & isolated in the worker process. The server runs on a thread like OctoPrint's, and is timed from a
+separate process so the client doesn't compete for the GIL.
+
+    python -m benchmarks.ui_latency
+"""
+import asyncio
+import multiprocessing
+import socket
+import statistics
+import threading
+import time
+import urllib.request
+
+import tornado.httpserver
+import tornado.web
+
+from benchmarks.harness import make_plugin, print_table
+
+LINES = 200_000
+RENDERS = 3
+
+PURGE_GRID = """{% for i in range(params.N|int) %}
+G1 X{{ i % 200 }} Y{{ (i * 7) % 180 }} E{{ '%.4f' % (i / 1000) }}
+{%- endfor %}"""
+
+
+class Ping(tornado.web.RequestHandler):
+    def get(self):
+        self.write("pong")
+
+
+def serve(sock, ready):
+    async def main():
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([("/", Ping)]))
+        server.add_sockets([sock])
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def poll(port, stop, results):
+    """
+    Client process, requests the page back to back until told to stop
+    """
+    url = f"http://127.0.0.1:{port}/"
+    requests = []
+    while not stop.is_set():
+        start = time.monotonic()
+        urllib.request.urlopen(url).read()
+        requests.append((start, time.monotonic() - start))
+    results.put(requests)
+
+
+def measure(port, render):
+    """
+    :param port: int, port the server is listening on
+    :param render: callable, renders the macro, None to measure the server on its own
+    :return: tuple of (list of response times in seconds of requests made while rendering, float, seconds spent
+        rendering)
+    """
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    client = multiprocessing.Process(target=poll, args=(port, stop, results))
+    client.start()
+    time.sleep(0.5)
+
+    start = time.monotonic()
+    if render is None:
+        time.sleep(2)
+    else:
+        for _ in range(RENDERS):
+            assert len(render()) == LINES
+    end = time.monotonic()
+
+    stop.set()
+    requests = results.get()
+    client.join()
+    latencies = [latency for made, latency in requests if start <= made < end]
+    return latencies, end - start
+
+
+def main():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(128)
+    sock.setblocking(False)
+    ready = threading.Event()
+    threading.Thread(target=serve, args=(sock, ready), daemon=True).start()
+    ready.wait()
+    port = sock.getsockname()[1]
+
+    plugin = make_plugin(
+        {
+            "purge": {"content": PURGE_GRID, "cache_result": False},
+            "purge_isolated": {
+                "content": PURGE_GRID,
+                "cache_result": False,
+                "isolated": True,
+            },
+        }
+    )
+
+    rows = []
+    for name, render in (
+        ("idle", None),
+        ("in process", lambda: plugin.render_macro(f"@purge N={LINES}")),
+        ("isolated", lambda: plugin.render_macro(f"@purge_isolated N={LINES}")),
+    ):
+        latencies, elapsed = measure(port, render)
+        latencies.sort()
+        rows.append(
+            (
+                name,
+                "" if render is None else f"{elapsed / RENDERS:.2f} s",
+                f"{len(latencies) / elapsed:.0f}",
+                f"{statistics.median(latencies) * 1000:.1f} ms",
+                f"{latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms",
+                f"{latencies[-1] * 1000:.1f} ms",
+            )
+        )
+    plugin.on_shutdown()
+    print_table(("render", "per render", "requests/s", "median", "p99", "max"), rows)
+
+
+if __name__ == "__main__":
+    main()
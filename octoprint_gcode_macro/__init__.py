@@ -1,10 +1,55 @@
+import copy
+import marshal
 import os
-from pathlib import Path
+import shutil
+import threading
+import time
+from collections import OrderedDict
 
+import flask
+import jinja2
 import octoprint.plugin
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import (
+    ChoiceLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    FunctionLoader,
+)
+from jinja2.sandbox import SecurityError
+from octoprint.events import Events
 
 from octoprint_gcode_macro import _version
+from octoprint_gcode_macro.gcode import split_commands
+from octoprint_gcode_macro.graph import analyse_call_graph
+from octoprint_gcode_macro.index import (
+    INDEX_FIELDS,
+    JINJA_EXTENSIONS,
+    analyse_macro,
+    content_hash,
+    index_entry,
+    is_static,
+)
+from octoprint_gcode_macro.isolated import IsolatedRenderer, IsolatedRenderError
+from octoprint_gcode_macro.loader import MacroLoader
+from octoprint_gcode_macro.params import (
+    MacroArgumentError,
+    ParameterSchema,
+    normalize_parameters,
+)
+from octoprint_gcode_macro.providers import ContextProviderError, ContextProviders
+from octoprint_gcode_macro.sandbox import SANDBOX_CODE_VERSION, BudgetedSandbox
+from octoprint_gcode_macro.state import PrinterStateSnapshot
+from octoprint_gcode_macro.stats import RenderStats, prometheus_metrics
+from octoprint_gcode_macro.storage import (
+    MACRO_INDEX_FILE,
+    FileStorage,
+    StorageError,
+    create_storage,
+)
+from octoprint_gcode_macro.variables import VariableStore
+from octoprint_gcode_macro.watcher import FileWatcher
+from octoprint_gcode_macro.worker import RenderTimeout, RenderWorker
 
 __version__ = _version.get_versions()["version"]
 del _version
@@ -18,11 +63,60 @@ FORBIDDEN_MACROS = [
     "resume",
 ]
 
+# Sub-macros are rendered up to this level, counting from 0 for the @ command that was sent
+MAX_MACRO_LEVEL = 4
+
+# Per-macro options, stored in the settings alongside the description, with their defaults
+MACRO_OPTIONS = {
+    # Reuse the rendered output while the template & its context are unchanged
+    "cache_result": True,
+    # Render in a separate process, for CPU-heavy templates
+    "isolated": False,
+    # Parameters the macro can be called with as @COMMAND KEY=VALUE, list of {"name", "type", "default", "min", "max"}
+    "parameters": [],
+}
+
+# Macros are loaded into Jinja as templates named "@command", so they go through the bytecode cache
+MACRO_TEMPLATE_PREFIX = "@"
+
+# Files in the data folder that belong to the plugin rather than being templates, not watched for changes
+WATCH_IGNORED = ("cache/", "variables.log", "macros.db", f"macros/{MACRO_INDEX_FILE}")
+
+
+def macro_options(macro):
+    """
+    Read the per-macro options from a macro's settings, filling in defaults for any that are missing
+    :param macro: dict, macro entry from the settings
+    :return: tuple of (dict of options, list of errors in the parameter declarations)
+    """
+    options = {
+        option: copy.deepcopy(macro.get(option, default))
+        for option, default in MACRO_OPTIONS.items()
+    }
+    options["parameters"], errors = normalize_parameters(options["parameters"])
+    return options, errors
+
+
+def freeze(value):
+    """
+    Turn a context value into something hashable, to use in a cache key
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(freeze(item) for item in value)
+    return value
+
 
 class GcodeMacroPlugin(
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,
+    octoprint.plugin.SimpleApiPlugin,
+    octoprint.plugin.BlueprintPlugin,
+    octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
+    octoprint.plugin.EventHandlerPlugin,
 ):
     def __init__(self):
         super().__init__()
@@ -30,11 +124,97 @@ class GcodeMacroPlugin(
         # Structure:
         # {
         #     "a command": {
-        #         "content": "Some example content",
         #         "description": "A description of the macro",
+        #         ...index entry (see index_entry): size, mtime, hash, references, static & analysis
+        #         ...options from MACRO_OPTIONS
+        #         "schema": ParameterSchema, validates the parameters the macro is called with
         #     }
         # }
 
+        # Macro content is only read from storage when the macro is first used, and compiled macros are evicted
+        # least recently used first when they go over the memory budget
+        self._compiled = OrderedDict()
+        self._compiled_bytes = 0
+        # Macros are loaded by the background loader as well as while rendering
+        self._compiled_lock = threading.RLock()
+        # Structure:
+        # {
+        #     "a command": {
+        #         "hash": "content hash the template was compiled from",
+        #         "size": int, bytes of content counted against the memory budget,
+        #         "flattened_size": int, bytes of the macro's flattened tree, counted as well while it's kept,
+        #         "template": jinja2.Template, None for static macros,
+        #         "commands": tuple of commands for static macros, None for templated ones,
+        #         "variables": frozenset of context variables the template reads,
+        #         "cacheable": bool, whether the template's output only depends on its content & context,
+        #         "code": bytes, marshalled template code for isolated rendering, None until first needed,
+        #         "budgeted": bool, whether the template can loop & needs the sandbox's loop budget,
+        #         "printer_fields": frozenset of printer state sections the template reads, None for all of them,
+        #         "includes": bool, whether the template includes other templates,
+        #         "stateful": bool, whether the template reads or saves persistent variables,
+        #     }
+        # }
+
+        # Rendered commands of templated macros, keyed by (command, content hash, referenced context values)
+        self._result_cache = OrderedDict()
+        self._result_cache_lock = threading.Lock()
+
+        self.call_graph = {}
+        # Structure:
+        # {
+        #     "a command": {
+        #         "calls": sorted list of macros called from this one,
+        #         "depth": int, levels of sub-macros below this one, None if it is/calls a circular macro,
+        #         "cyclic": bool, whether this macro is part of or calls a circular macro,
+        #     }
+        # }
+        self.call_cycles = []
+
+        # Every @ command that is a macro we can render, checked for every line sent to the printer
+        self._at_commands = frozenset()
+        # First word of each of those, so @ commands with arguments can be turned away without parsing them
+        self._at_command_words = frozenset()
+        # Most spaces in any macro's command, arguments past that many spaces can't be part of the command
+        self._command_spaces = 0
+
+        # Fully expanded commands of static macros that only call other static macros, by command, worked out when
+        # first used. None for macros that can't be flattened, empty for empty macros.
+        self._flattened = {}
+
+        # Number of macro renders that took the static and templated paths
+        self.render_counts = {"static": 0, "templated": 0}
+        self.stats = RenderStats()
+
+        # Content of the macro being compiled on each thread, handed to the Jinja loader so it isn't read twice
+        self._compiling = threading.local()
+
+        # Checks stored macros against the index & precompiles macros in the background at startup
+        self.macro_loader = MacroLoader(self.preload_macro)
+        self._index_changed = False
+        # Macros whose index entries haven't been checked against storage yet, they may be stale or placeholders
+        self._unchecked = set()
+        self._load_start = 0.0
+
+        # Renders templates off the comm thread when there is a render timeout
+        self.render_worker = RenderWorker()
+        # Renders isolated macros in a separate process, created in initialize
+        self.isolated_renderer: IsolatedRenderer
+
+        # Printer state for templates, updated from callbacks & events rather than queried while rendering
+        self.printer_state = PrinterStateSnapshot()
+        # Context variables from other plugins, created in initialize
+        self.context_providers: ContextProviders
+        # Variables saved by macros, created in initialize
+        self.variables: VariableStore
+
+        # Copies of settings used while rendering, see update_options
+        self._result_cache_size = 0
+        self._macro_memory = 0
+        self._preload_threads = 0
+        self._render_timeout = 0.0
+        self._context_ttl = 0.0
+        self._sandbox_options = None
+
         self.jinja_env: Environment
 
     # SettingsPlugin mixin
@@ -46,7 +226,27 @@ class GcodeMacroPlugin(
                     "content": "M117 Hello!",
                     "description": "An example macro you can customize",
                 }
-            ]
+            ],
+            # Where macros are kept, "files" or "sqlite", read at startup
+            "storage": "files",
+            # Reload macro files & included templates when they are changed on disk, read at startup
+            "watch_files": True,
+            "result_cache_size": 256,
+            # kB of macros to keep loaded & compiled, 0 for no limit
+            "macro_memory_kb": 8192,
+            # Threads to load & compile macros with in the background at startup, 0 to load them as they are used
+            "preload_threads": 4,
+            # Seconds a template may take to render before it is abandoned, 0 to render on the comm thread
+            "render_timeout": 0,
+            # Seconds to reuse values from other plugins' context providers for, unless they set their own
+            "context_ttl": 1.0,
+            # Render in Jinja's sandbox, with limits on how much work a template can do
+            "sandbox": {
+                "enabled": False,
+                "max_loop_iterations": 1000000,
+                "max_output_bytes": 20000000,
+                "max_output_lines": 500000,
+            },
         }
 
     def get_settings_version(self):
@@ -54,30 +254,152 @@ class GcodeMacroPlugin(
 
     def initialize(self):
         # Data folder is not available until now
-        self.jinja_env = Environment(
-            loader=FileSystemLoader(self.get_plugin_data_folder()),
+        self.isolated_renderer = IsolatedRenderer(self.get_plugin_data_folder())
+        self._printer.register_callback(self.printer_state)
+        self.context_providers = ContextProviders(self._logger)
+        self.variables = VariableStore(
+            os.path.join(self.get_plugin_data_folder(), "variables.log"), self._logger
         )
+        self.update_options()
+        self.storage = self.create_storage()
+        self.watcher = self.create_watcher()
+        self.jinja_env = self.create_jinja_env()
         self.load_macros()
+        if self.watcher is not None:
+            self.watcher.start()
+
+    def create_storage(self):
+        backend = self._settings.get(["storage"])
+        try:
+            return create_storage(backend, self.get_plugin_data_folder(), self._logger)
+        except ValueError as e:
+            self._logger.warning(f"{e}, using files")
+            return create_storage("files", self.get_plugin_data_folder(), self._logger)
+
+    def create_watcher(self):
+        if not self._settings.get_boolean(["watch_files"]):
+            return None
+        return FileWatcher(
+            self.get_plugin_data_folder(),
+            self.reload_changed_files,
+            ignore=WATCH_IGNORED,
+            logger=self._logger,
+        )
+
+    def update_options(self):
+        # Settings are read often while rendering, keep a copy rather than going through the settings each time
+        self._result_cache_size = self._settings.get_int(["result_cache_size"])
+        self._macro_memory = self._settings.get_int(["macro_memory_kb"]) * 1024
+        self._preload_threads = self._settings.get_int(["preload_threads"])
+        self._render_timeout = self._settings.get_float(["render_timeout"])
+        self._context_ttl = self._settings.get_float(["context_ttl"])
+
+        sandbox_options = {
+            "enabled": self._settings.get_boolean(["sandbox", "enabled"]),
+            "max_loop_iterations": self._settings.get_int(
+                ["sandbox", "max_loop_iterations"]
+            ),
+            "max_output_bytes": self._settings.get_int(["sandbox", "max_output_bytes"]),
+            "max_output_lines": self._settings.get_int(["sandbox", "max_output_lines"]),
+        }
+        if sandbox_options != self._sandbox_options:
+            self._sandbox_options = sandbox_options
+            self.isolated_renderer.configure(sandbox_options)
+            if hasattr(self, "jinja_env"):
+                # Templates compiled for the old environment can't be used with the new one
+                self.jinja_env = self.create_jinja_env()
+                self.recompile_macros()
+
+    def create_jinja_env(self):
+        options = {
+            "loader": ChoiceLoader(
+                [
+                    FunctionLoader(self.load_macro_template),
+                    FileSystemLoader(self.get_plugin_data_folder()),
+                ]
+            ),
+            "bytecode_cache": FileSystemBytecodeCache(self.get_bytecode_cache_folder()),
+            # For {% do save_variable(...) %}
+            "extensions": list(JINJA_EXTENSIONS),
+            # Changed templates are forgotten as the watcher finds them, rather than checked on every render
+            "auto_reload": self.watcher is None,
+        }
+
+        if not self._sandbox_options["enabled"]:
+            env = Environment(**options)
+        else:
+            env = BudgetedSandbox(
+                max_loop_iterations=self._sandbox_options["max_loop_iterations"],
+                max_output_bytes=self._sandbox_options["max_output_bytes"],
+                max_output_lines=self._sandbox_options["max_output_lines"],
+                **options,
+            )
+
+        env.globals["save_variable"] = self.variables.save
+        env.globals["variables"] = self.variables.values
+        return env
+
+    def recompile_macros(self):
+        # Templates compiled for another environment can't be used, they are compiled again when next used
+        with self._compiled_lock:
+            self._compiled = OrderedDict()
+            self._compiled_bytes = 0
+            self._flattened = {}
+        with self._result_cache_lock:
+            self._result_cache.clear()
+
+    def get_bytecode_cache_folder(self):
+        """
+        Compiled templates are cached on disk per Jinja version, so the first render after a restart is cheap.
+        Caches left behind by other Jinja versions, or older versions of the sandbox, are removed. The sandbox
+        compiles templates differently, so it has its own cache.
+        """
+        cache_root = os.path.join(self.get_plugin_data_folder(), "cache")
+        version_folder = os.path.join(cache_root, jinja2.__version__)
+        sandbox_folder = os.path.join(version_folder, f"sandbox{SANDBOX_CODE_VERSION}")
+        default_folder = os.path.join(version_folder, "default")
+        cache_folder = (
+            sandbox_folder if self._sandbox_options["enabled"] else default_folder
+        )
+
+        if os.path.isdir(cache_root):
+            for entry in os.scandir(cache_root):
+                if entry.is_dir() and entry.path != version_folder:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        if os.path.isdir(version_folder):
+            for entry in os.scandir(version_folder):
+                if entry.is_dir() and entry.path not in (
+                    sandbox_folder,
+                    default_folder,
+                ):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+        os.makedirs(cache_folder, exist_ok=True)
+        return cache_folder
 
     def on_settings_migrate(self, target, current):
         if current is None:
-            # Need to migrate macro content from settings to files
+            # Need to migrate macro content from settings to storage
             self.save_macros(self._settings.get(["macros"], merged=True))
 
     def on_settings_save(self, data):
-        self.save_macros(data["macros"])
-        # Remove the macro content to save any other settings
-        data.pop("macros")
+        if "macros" in data:
+            self.save_macros(data["macros"])
+            # Remove the macro content to save any other settings
+            data.pop("macros")
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.update_options()
 
     def on_settings_load(self):
         data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
         # Add content to the macros from settings & make into list
+        # Content is read straight from storage, rather than loading every macro into memory
         macros = [
             {
                 "command": command,
-                "content": data["content"],
+                "content": self.get_macro_content(command),
                 "description": data["description"],
+                **{option: data[option] for option in MACRO_OPTIONS},
             }
             for command, data in self.macros.items()
         ]
@@ -87,46 +409,110 @@ class GcodeMacroPlugin(
 
     def load_macros(self):
         """
-        Macros are stored as files in the plugin data folder (+ /macros) and are loaded into memory & available on the
-        settings API to edit.
+        Macros are kept by the storage backend, as files in the plugin data folder (+ /macros) by default. Only their
+        index is loaded at startup, their content is read when they are first used, or when the settings are loaded to
+        edit them.
+        With preloading, macros are checked against the index & compiled in the background instead, and this returns
+        without reading any of them.
         """
-        macro_path = os.path.join(self.get_plugin_data_folder(), "macros")
+        # Settings entries by command, the first one wins if there are duplicates
+        macros_settings = {}
+        for macro in self._settings.get(["macros"]):
+            macros_settings.setdefault(macro["command"], macro)
 
-        # We don't support folders here, just files in one pile. They have the extension .gcode, filename is the command
-        # to match with an entry in the settings
+        try:
+            entries = self.storage.load(
+                macros_settings, check=not self._preload_threads
+            )
+        except StorageError as e:
+            self._logger.error(e)
+            entries = {}
+        # Checked by the background loader, until then their references & whether they're static can't be trusted
+        self._unchecked = set(entries) if self._preload_threads else set()
 
-        macros_settings = self._settings.get(["macros"])
-        existing_commands = [
-            macro["command"] for macro in self._settings.get(["macros"])
-        ]
+        for command, entry in entries.items():
+            macro_settings = macros_settings[command]
+            options, _ = macro_options(macro_settings)
+            self.macros[command] = {
+                "description": macro_settings["description"],
+                **entry,
+                **options,
+                "schema": ParameterSchema(options["parameters"]),
+            }
 
-        for file in Path(macro_path).glob("*.gcode"):
-            command = os.path.splitext(file.name)[0]
-            if command not in existing_commands:
-                # Ignore if no settings entry for this file
-                # So we don't try and pick up random files I hope
-                continue
+        self.update_at_commands()
+        self.build_call_graph()
+        self.warm_up_isolated_renderer()
 
-            # I *think* this works, it was suggested by copilot
-            description = macros_settings[existing_commands.index(command)][
-                "description"
-            ]
+        if self._preload_threads:
+            self._index_changed = False
+            self._load_start = time.perf_counter()
+            self.macro_loader.start(
+                list(self.macros), self._preload_threads, self.finish_preloading
+            )
 
-            with open(file) as f:
-                content = f.read()
+    def preload_macro(self, command):
+        """
+        Check a macro against its index entry & compile it if it fits in the memory budget, run by the background
+        loader
+        :param command: string, macro to load
+        """
+        macro = self.macros.get(command)
+        if macro is None:
+            return
 
-            self.macros[command] = {
-                "content": content,
-                "description": description,
-            }
+        try:
+            entry, content = self.storage.check(
+                command, {field: macro[field] for field in INDEX_FIELDS}
+            )
+        except StorageError as e:
+            self._logger.error(e)
+            return
+
+        if content is not None:
+            macro.update(entry)
+            self._index_changed = True
+        self._unchecked.discard(command)
+
+        if (
+            not self._macro_memory
+            or self._compiled_bytes + macro["size"] <= self._macro_memory
+        ):
+            self.compile_macro(command, content)
+
+    def finish_preloading(self):
+        if self._index_changed:
+            # Macro files changed while OctoPrint was stopped, they may call different macros now
+            self.storage.save_index(self.macros)
+            self.build_call_graph()
+
+        self._logger.info(
+            f"Loaded {len(self._compiled)} of {len(self.macros)} macros in the background "
+            f"in {time.perf_counter() - self._load_start:.2f}s"
+        )
 
     def save_macros(self, macros, save=False):
-        macro_path = os.path.join(self.get_plugin_data_folder(), "macros")
-        if not os.path.isdir(macro_path):
-            # Make the `macros` folder if it doesn't exist
-            os.makedirs(macro_path)
+        """
+        Save macros from the settings, storing only the macros that are new or have changed content
+        :param macros: list of macros from the settings, with content
+        :param save: bool, whether to save OctoPrint's settings as well
+        :return: dict, counts of macros written, unchanged and removed, and bytes written
+        """
+        # Anything still loading in the background is for the old macros
+        self.macro_loader.stop()
+
+        previous = self.macros
+        incoming = {macro["command"] for macro in macros}
+        removed = [
+            command
+            for command in previous
+            if command not in incoming or command in FORBIDDEN_MACROS
+        ]
+        summary = {"written": 0, "unchanged": 0, "removed": len(removed), "bytes": 0}
 
         self.macros = {}
+        contents = {}
+        entries = {}
         for macro in macros:
             command = macro["command"]
             content = macro["content"]
@@ -138,19 +524,87 @@ class GcodeMacroPlugin(
                 )
                 continue
 
-            file_path = Path(macro_path) / f"{command}.gcode"
+            digest = content_hash(content)
+            if command in previous and previous[command]["hash"] == digest:
+                summary["unchanged"] += 1
+                entry = {field: previous[command][field] for field in INDEX_FIELDS}
+            else:
+                contents[command] = content
+                # Size & mtime are filled in once it is stored
+                entry = entries[command] = index_entry(content, len(content), None)
+                self._unchecked.discard(command)
+                self.drop_compiled(command)
 
-            with open(file_path, "w") as f:
-                f.write(content)
+            options, errors = macro_options(macro)
+            if errors:
+                self._logger.warning(
+                    f"Invalid parameters for macro {command} were dropped: "
+                    + "; ".join(errors)
+                )
+                self._plugin_manager.send_plugin_message(
+                    "gcode_macro",
+                    {
+                        "type": "invalid_parameters",
+                        "command": command,
+                        "errors": errors,
+                    },
+                )
 
             self.macros[command] = {
-                "content": content,
                 "description": description,
+                **entry,
+                **options,
+                "schema": ParameterSchema(options["parameters"]),
             }
 
+        if contents or removed:
+            try:
+                summary["bytes"], stored = self.storage.write(
+                    contents, entries, removed
+                )
+                summary["written"] = len(contents)
+                for command, fields in stored.items():
+                    self.macros[command].update(fields)
+            except StorageError as e:
+                self._logger.error(e)
+                # Macros still have their old content, make sure they are written next time
+                for command in contents:
+                    self.macros[command]["hash"] = None
+            self.storage.save_index(self.macros)
+
+        self._logger.info(
+            f"Saved macros: {summary['written']} written ({summary['bytes']} bytes), "
+            f"{summary['unchanged']} unchanged, {summary['removed']} removed"
+        )
+
+        # Drop compiled templates for macros that changed while they were being stored, or no longer exist
+        self.invalidate_macros(
+            set(contents)
+            | {
+                command
+                for command in list(self._compiled)
+                if command not in self.macros
+            }
+        )
+        self.stats.prune(self.macros.keys())
+        with self._result_cache_lock:
+            self._result_cache.clear()
+
+        self.update_at_commands()
+        self.build_call_graph()
+        self.warm_up_isolated_renderer()
+        if self.call_cycles:
+            self._plugin_manager.send_plugin_message(
+                "gcode_macro", {"type": "circular_macros", "cycles": self.call_cycles}
+            )
+
         # Remove the content to save to settings as a list
         settings_macros = [
-            {"command": command, "description": data["description"]}
+            {
+                "command": command,
+                "description": data["description"],
+                **{option: data[option] for option in MACRO_OPTIONS},
+            }
             for command, data in self.macros.items()
         ]
 
@@ -159,6 +613,93 @@ class GcodeMacroPlugin(
             # Usually this is called as part of OctoPrint's settings saving, which would do this for us
             self._settings.save()
 
+        return summary
+
+    def reload_changed_files(self, paths):
+        """
+        Reload macros & forget included templates that were changed on disk, called by the watcher with each batch
+        of changes
+        :param paths: set of changed paths, relative to the data folder & separated by /
+        """
+        commands = set()
+        if isinstance(self.storage, FileStorage):
+            macro_folder = os.path.relpath(
+                self.storage.folder, self.get_plugin_data_folder()
+            ).replace(os.sep, "/")
+            for path in paths:
+                folder, _, name = path.rpartition("/")
+                if folder == macro_folder and name.endswith(".gcode"):
+                    commands.add(name[: -len(".gcode")])
+
+        # Included templates are named by their path, anything else changed is just not in Jinja's cache
+        self.forget_templates(paths)
+        changed = self.reload_macros(commands) if commands else set()
+        if changed:
+            self._logger.info(f"Reloaded {len(changed)} macros changed on disk")
+
+    def reload_macros(self, commands):
+        """
+        Check macros against their files again, picking up any that were added, changed or removed. Only macros
+        whose content changed are recompiled.
+        :param commands: iterable of commands to check
+        :return: set of macros that changed
+        """
+        macros_settings = {}
+        for macro in self._settings.get(["macros"]):
+            macros_settings.setdefault(macro["command"], macro)
+
+        changed = set()
+        for command in commands:
+            macro = self.macros.get(command)
+
+            if not os.path.exists(self.storage.get_path(command)):
+                if macro is not None:
+                    del self.macros[command]
+                    changed.add(command)
+                continue
+
+            try:
+                entry, content = self.storage.check(
+                    command,
+                    None
+                    if macro is None
+                    else {field: macro[field] for field in INDEX_FIELDS},
+                )
+            except StorageError as e:
+                self._logger.error(e)
+                continue
+            self._unchecked.discard(command)
+
+            if macro is None:
+                macro_settings = macros_settings.get(command)
+                if macro_settings is None or command in FORBIDDEN_MACROS:
+                    # Ignored, like it would be at startup
+                    continue
+                options, _ = macro_options(macro_settings)
+                self.macros[command] = {
+                    "description": macro_settings["description"],
+                    **entry,
+                    **options,
+                    "schema": ParameterSchema(options["parameters"]),
+                }
+                changed.add(command)
+            elif content is not None:
+                previous_hash = macro["hash"]
+                macro.update(entry)
+                if entry["hash"] != previous_hash:
+                    changed.add(command)
+
+        if not changed:
+            return changed
+
+        self.invalidate_macros(changed)
+        self.storage.save_index(self.macros)
+        self.stats.prune(self.macros.keys())
+        self.update_at_commands()
+        self.build_call_graph()
+        self.warm_up_isolated_renderer()
+        return changed
+
     # AssetPlugin mixin
     def get_assets(self):
         return {
@@ -178,78 +719,841 @@ class GcodeMacroPlugin(
         *args,
         **kwargs,
     ):
-        if command.startswith("@"):
+        # This runs for every line sent to the printer, anything that's not a macro needs to get out of here fast
+        self.stats.queueing_calls += 1
+        if not command.startswith("@"):
+            return
+
+        # Macros called with parameters need splitting up to find the command
+        if command in self._at_commands or (
+            command.partition(" ")[0] in self._at_command_words
+            and self.lookup_macro(command) is not None
+        ):
+            self.stats.macro_hits += 1
             return self.render_macro(command)
 
-    def render_macro(self, command, level=0):
+    def warm_up_isolated_renderer(self):
+        # Start the process now, rather than making the first isolated render wait for it
+        if any(macro["isolated"] for macro in self.macros.values()):
+            self.isolated_renderer.warm_up()
+
+    def update_at_commands(self):
+        self._at_commands = frozenset(
+            f"@{command}" for command in self.macros if command not in FORBIDDEN_MACROS
+        )
+        self._at_command_words = frozenset(
+            command.partition(" ")[0] for command in self._at_commands
+        )
+        self._command_spaces = max(
+            (command.count(" ") for command in self.macros), default=0
+        )
+
+    def lookup_macro(self, command):
+        """
+        Find the macro an @ command refers to
+        :param command: string, @ command
+        :return: string, the macro's command, or None if it is not a macro we can render
+        """
+        parsed = self.parse_macro_call(command)
+        return parsed[0] if parsed is not None else None
+
+    def parse_macro_call(self, line):
+        """
+        Split an @ command into the macro it calls and its arguments. Macro commands can contain spaces, so the
+        longest command that matches a macro wins.
+        :param line: string, @ command, like `@PRINT_START BED=60 EXTRUDER=215`
+        :return: tuple of (macro command, arguments string), or None if it is not a macro we can render
+        """
+        command = line.strip("@")
+        arguments = ""
+        end = len(line)
+        if command in FORBIDDEN_MACROS or command not in self.macros:
+            # Start from the longest command a macro could have, rather than trying every argument
+            start = -1
+            for _ in range(self._command_spaces + 1):
+                start = line.find(" ", start + 1)
+                if start == -1:
+                    break
+            else:
+                end = start + 1
+        while command in FORBIDDEN_MACROS or command not in self.macros:
+            # Forbidden, illegal, not a macro command - see if it's a macro followed by arguments
+            end = line.rfind(" ", 0, end)
+            if end == -1:
+                return None
+            command = line[:end].strip("@")
+            arguments = line[end + 1 :]
+
+        return command, arguments
+
+    def render_macro(self, command):
         """
-        Render a macro from a command
+        Render a macro from a command, including any sub-macros it contains
         :param command: string, macro to lookup
-        :param level: int, number of sub-macros that have been rendered
         :return: list, list of commands to send to the printer
         """
-        command = command.strip("@")
-
-        if command in FORBIDDEN_MACROS or command not in self.macros.keys():
-            # Forbidden, illegal, not a macro command, ignore, leave command unchanged.
+        parsed = self.parse_macro_call(command)
+        if parsed is None:
+            # Leave command unchanged.
             return
+        command, arguments = parsed
 
         self._logger.debug(f"Rendering macro for @ command @{command}")
 
-        content = self.render_with_jinja(command)
+        start = time.perf_counter()
+        result, depth = self.expand_macro(command, arguments)
+        self.stats.record_render(
+            command, time.perf_counter() - start, len(result) if result else 0, depth
+        )
 
-        if content and isinstance(content, str):
-            # Split long string into list of commands for OctoPrint to digest
-            commands = content.split("\n")
-            # Strip gcode comments & whitespace
-            commands = list(map(lambda x: x.split(";")[0].strip(), commands))
+        return result
 
-            result = []
+    def expand_macro(self, command, arguments=""):
+        """
+        Render a macro and all of its sub-macros
+        :param command: string, macro to render
+        :param arguments: string, KEY=VALUE arguments the macro was called with
+        :return: tuple of (list of commands or None if it rendered nothing, deepest level of sub-macros rendered)
+        """
+        flattened = self.get_flattened_commands(command, 0)
+        if flattened is not None:
+            return list(flattened), self.call_graph[command]["depth"]
+
+        commands = self.get_macro_commands(command, arguments)
+        if not commands:
+            # If in doubt, just return nothing so the command remains unchanged.
+            return None, 0
+
+        result = []
+        depth = 0
+
+        # Sub-macros are expanded depth first using a stack of (commands iterator, level) rather than recursion.
+        # Only render up to 5 levels (0 start)
+        # Seems like a sane limit, don't want crashes from circular macros
+        stack = [(iter(commands), 0)]
+        while stack:
+            commands, level = stack[-1]
+            for cmd in commands:
+                if not cmd.startswith("@"):
+                    result.append(cmd)
+                    continue
+
+                parsed = self.parse_macro_call(cmd)
+                if parsed is None:
+                    continue
+                submacro, subarguments = parsed
 
-            if level <= 4:
-                # Only render up to 5 levels (0 start)
-                # Seems like a sane limit, don't want crashes from circular macros
-                for cmd in commands:
-                    if cmd.startswith("@"):
-                        # Recursively render for each @ command in macro
-                        submacro = self.render_macro(cmd, level=level + 1)
-                        if submacro:
-                            result += submacro
-                    else:
-                        result += [cmd]
+                self._logger.debug(f"Rendering macro for @ command @{submacro}")
+
+                flattened = self.get_flattened_commands(submacro, level + 1)
+                if flattened is not None:
+                    result.extend(flattened)
+                    depth = max(depth, level + 1 + self.call_graph[submacro]["depth"])
+                    continue
+
+                subcommands = self.get_macro_commands(submacro, subarguments)
+                if not subcommands:
+                    continue
+
+                if level >= MAX_MACRO_LEVEL:
+                    self._logger.warning(
+                        f"Recursive limit hit trying to render macro {submacro}"
+                    )
+                    continue
+
+                # Carry on with this macro's commands once the sub-macro is done
+                stack.append((iter(subcommands), level + 1))
+                depth = max(depth, level + 1)
+                break
             else:
-                self._logger.warning(
-                    f"Recursive limit hit trying to render macro {command}"
+                stack.pop()
+
+        return result, depth
+
+    def get_flattened_commands(self, command, level):
+        """
+        Get the pre-expanded commands of a static macro tree, if it fits within the level limit from here
+        :param command: string, macro to render
+        :param level: int, level the macro is being rendered at
+        :return: tuple, all commands of the macro & its sub-macros, or None if it needs expanding at runtime
+        """
+        node = self.call_graph.get(command)
+        if (
+            node is None
+            or node["depth"] is None
+            or not self.is_checked(command)
+            or not self.macros[command]["static"]
+            or level + node["depth"] > MAX_MACRO_LEVEL
+        ):
+            return None
+
+        if command in self._flattened:
+            flattened = self._flattened[command]
+        else:
+            flattened = self.flatten_macro(command)
+        if not flattened:
+            # Can't be flattened, or an empty macro which is left alone so the command remains unchanged
+            return None
+
+        with self._compiled_lock:
+            if command in self._compiled:
+                self._compiled.move_to_end(command)
+        self.render_counts["static"] += 1
+        self.stats.record_cache(command, True)
+        return flattened
+
+    def is_checked(self, command):
+        """
+        Whether a macro's index entry is known to match its content, so the call graph can be trusted for it
+        :param command: string, macro
+        :return: bool
+        """
+        return (
+            command not in self._unchecked and self.macros[command]["hash"] is not None
+        )
+
+    def build_call_graph(self):
+        """
+        Work out which macros call each other, so circular macros can be found when they are saved rather than
+        when they are rendered, and trees of static macros can be expanded once up front.
+        """
+        calls = {}
+        for command, macro in self.macros.items():
+            calls[command] = {
+                sub
+                for sub in map(self.lookup_macro, macro["references"])
+                if sub is not None
+            }
+
+        order, depths, cycles = analyse_call_graph(calls)
+
+        self.call_graph = {
+            command: {
+                "calls": sorted(calls[command]),
+                "depth": depths[command],
+                "cyclic": depths[command] is None,
+            }
+            for command in calls
+        }
+        self.call_cycles = cycles
+        for cycle in cycles:
+            self._logger.warning(
+                "Circular macros found, these will stop rendering at the recursion limit: "
+                + ", ".join(f"@{command}" for command in cycle)
+            )
+
+        # Flattened macros can include any of the others, worked out again as they are used
+        self.forget_flattened()
+
+    def flatten_macro(self, command):
+        """
+        Expand a static macro tree into a single list of commands, loading the macros in it as needed
+        :param command: string, static macro that is not circular
+        :return: tuple, all commands of the macro & its sub-macros, empty for an empty macro, or None if it can't
+            be flattened
+        """
+        # Kept here as well as in self._flattened, as loading macros further down the tree can evict others
+        results = {}
+        # Macros waiting for their sub-macros to be flattened
+        in_progress = set()
+
+        # Sub-macros are flattened before their callers, using a stack rather than recursion
+        stack = [command]
+        while stack:
+            current = stack[-1]
+            if current in results:
+                stack.pop()
+                continue
+            if current in self._flattened:
+                results[current] = self._flattened[current]
+                stack.pop()
+                continue
+            if not self.is_checked(current):
+                # The call graph this was flattened by may be wrong, expand it at runtime until it's checked
+                return None
+
+            compiled = self.get_compiled(current)
+            if compiled is None or compiled["commands"] is None:
+                # Templated (or broken) macro, has to be rendered at runtime
+                results[current] = None
+                stack.pop()
+                continue
+
+            subs = [
+                self.lookup_macro(cmd)
+                for cmd in compiled["commands"]
+                if cmd.startswith("@")
+            ]
+            pending = [sub for sub in subs if sub is not None and sub not in results]
+            if pending:
+                if current in in_progress or in_progress.intersection(pending):
+                    # Circular after all, the call graph didn't know it calls itself
+                    return None
+                in_progress.add(current)
+                stack.extend(pending)
+                continue
+
+            result = []
+            for cmd in compiled["commands"]:
+                if not cmd.startswith("@"):
+                    result.append(cmd)
+                    continue
+
+                submacro = self.lookup_macro(cmd)
+                if submacro is None:
+                    # Not a macro, renders nothing
+                    continue
+                if results[submacro] is None:
+                    result = None
+                    break
+                result.extend(results[submacro])
+
+            results[current] = tuple(result) if result is not None else None
+            in_progress.discard(current)
+            stack.pop()
+
+        with self._compiled_lock:
+            for current, flattened in results.items():
+                compiled = self._compiled.get(current)
+                if compiled is None or current in self._flattened:
+                    # Evicted while loading the rest of the tree, worked out again next time
+                    continue
+                self._flattened[current] = flattened
+                if flattened:
+                    # Flattened trees are dropped with the macro, count them against the memory budget too
+                    compiled["flattened_size"] = sum(len(cmd) + 1 for cmd in flattened)
+                    self._compiled_bytes += compiled["flattened_size"]
+
+        return results[command]
+
+    def get_compiled(self, command):
+        """
+        Get a compiled macro, loading & compiling it if it's not in memory
+        :param command: string, macro
+        :return: dict, compiled macro (see self._compiled), or None if it is not a macro or could not be compiled
+        """
+        with self._compiled_lock:
+            compiled = self._compiled.get(command)
+            if compiled is not None:
+                self._compiled.move_to_end(command)
+                return compiled
+        if command not in self.macros:
+            return None
+
+        # Only waits for this macro if it's still being loaded in the background
+        self.macro_loader.wait(command)
+        with self._compiled_lock:
+            compiled = self._compiled.get(command)
+        if compiled is not None:
+            return compiled
+        return self.compile_macro(command)
+
+    def store_compiled(self, command, compiled):
+        """
+        Keep a compiled macro in memory, evicting the least recently used ones that go over the memory budget
+        :param command: string, macro
+        :param compiled: dict, compiled macro
+        """
+        evicted = set()
+        with self._compiled_lock:
+            self.drop_compiled(command)
+            self._compiled[command] = compiled
+            self._compiled_bytes += compiled["size"] + compiled["flattened_size"]
+
+            while (
+                self._macro_memory
+                and self._compiled_bytes > self._macro_memory
+                and len(self._compiled) > 1
+            ):
+                name, entry = self._compiled.popitem(last=False)
+                self._compiled_bytes -= entry["size"] + entry["flattened_size"]
+                self._flattened.pop(name, None)
+                evicted.add(MACRO_TEMPLATE_PREFIX + name)
+
+        # Jinja keeps its own copy of every template it loaded, which would outlive the memory budget
+        self.forget_templates(evicted)
+
+    def drop_compiled(self, command):
+        with self._compiled_lock:
+            compiled = self._compiled.pop(command, None)
+            if compiled is not None:
+                self._compiled_bytes -= compiled["size"] + compiled["flattened_size"]
+            self._flattened.pop(command, None)
+
+    def forget_flattened(self):
+        """
+        Drop all flattened macro trees, releasing the memory they were counted for
+        """
+        with self._compiled_lock:
+            for compiled in self._compiled.values():
+                self._compiled_bytes -= compiled["flattened_size"]
+                compiled["flattened_size"] = 0
+            self._flattened = {}
+
+    def forget_templates(self, names):
+        """
+        Remove templates from Jinja's cache, which isn't checked for changes while files are watched
+        :param names: collection of template names
+        """
+        cache = self.jinja_env.cache
+        if cache is None or not names:
+            return
+        for key in list(cache.keys()):
+            if key[1] in names:
+                try:
+                    del cache[key]
+                except KeyError:
+                    # Evicted in the meantime
+                    pass
+
+    def invalidate_macros(self, commands):
+        """
+        Forget everything compiled or rendered from macros whose content has changed
+        :param commands: collection of macros
+        """
+        # Jinja's copy goes first, so a macro compiled in between from the old template is dropped too
+        self.forget_templates({MACRO_TEMPLATE_PREFIX + command for command in commands})
+        for command in commands:
+            self.drop_compiled(command)
+        with self._result_cache_lock:
+            for key in [key for key in self._result_cache if key[0] in commands]:
+                del self._result_cache[key]
+
+    def get_macro_commands(self, command, arguments=""):
+        """
+        Get the commands for a single macro, without rendering any sub-macros
+        :param command: string, macro to render
+        :param arguments: string, KEY=VALUE arguments the macro was called with
+        :return: tuple, commands for this macro, empty if it rendered nothing
+        """
+        loaded = command in self._compiled
+        compiled = self.get_compiled(command)
+        if compiled is not None and compiled["commands"] is not None:
+            # Static macro, no need to go near Jinja
+            self.render_counts["static"] += 1
+            self.stats.record_cache(command, loaded)
+            return compiled["commands"]
+
+        self.render_counts["templated"] += 1
+        self.stats.record_cache(command, loaded and compiled is not None)
+
+        try:
+            params = self.get_macro_params(command, arguments)
+            context = self.get_render_context(command, params)
+        except (MacroArgumentError, ContextProviderError) as e:
+            self.report_render_error(command, e)
+            return ()
+
+        if (
+            compiled is None
+            or not compiled["cacheable"]
+            or not self.macros[command]["cache_result"]
+        ):
+            return self.render_commands(command, compiled, context) or ()
+
+        key = (
+            command,
+            compiled["hash"],
+            tuple(
+                (name, freeze(context[name]))
+                for name in sorted(compiled["variables"])
+                if name in context
+            ),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            # A context provider returned a value that can't be compared, so the output can't be reused
+            return self.render_commands(command, compiled, context) or ()
+
+        with self._result_cache_lock:
+            commands = self._result_cache.get(key)
+            if commands is not None:
+                self._result_cache.move_to_end(key)
+        self.stats.record_result_cache(command, commands is not None)
+        if commands is not None:
+            return commands
+
+        commands = self.render_commands(command, compiled, context)
+        if commands is None:
+            # Don't cache errors, they should be reported every time
+            return ()
+
+        with self._result_cache_lock:
+            self._result_cache[key] = commands
+            while len(self._result_cache) > self._result_cache_size:
+                self._result_cache.popitem(last=False)
+
+        return commands
+
+    def render_commands(self, command, compiled, context):
+        """
+        Render a templated macro into commands, in a separate process for isolated macros
+        :param command: string, macro to render
+        :param compiled: dict, compiled macro (see self._compiled), None if compiling failed
+        :param context: dict, variables available to the template
+        :return: tuple, rendered commands, or None if there was an error
+        """
+        if compiled is None or not self.macros[command]["isolated"]:
+            content = self.render_with_jinja(command, context)
+            return None if content is None else split_commands(content)
+
+        if compiled["stateful"]:
+            # Globals don't reach the worker process, send a copy of the saved variables to read
+            context = {**context, "variables": dict(self.variables.values)}
+
+        try:
+            if compiled["code"] is None:
+                compiled["code"] = marshal.dumps(
+                    self.jinja_env.compile(
+                        self.get_macro_content(command), MACRO_TEMPLATE_PREFIX + command
+                    )
                 )
+            return self.isolated_renderer.render(
+                MACRO_TEMPLATE_PREFIX + command,
+                compiled["hash"],
+                compiled["code"],
+                context,
+                self._render_timeout or None,
+            )
+        except Exception as e:
+            self.report_render_error(command, e)
+            return None
+
+    def get_macro_params(self, command, arguments):
+        """
+        Work out the parameters for a macro call: declared defaults, overridden by the arguments it was called with.
+        Declared parameters are converted to their type & checked against their limits, others are left as strings.
+        :param command: string, macro being rendered
+        :param arguments: string, KEY=VALUE arguments the macro was called with
+        :return: dict, parameter name -> value
+        :raises MacroArgumentError: if the arguments don't match the macro's declared parameters
+        """
+        return self.macros[command]["schema"](arguments)
 
-            return result
+    def get_render_context(self, command, params):
+        """
+        Build the context a macro's template is rendered with
+        :param command: string, macro being rendered
+        :param params: dict, parameters the macro was called with
+        :return: dict
+        :raises ContextProviderError: if a context provider the template uses failed
+        """
+        context = {"params": params}
+
+        compiled = self._compiled.get(command)
+        if compiled is None:
+            return context
+
+        if compiled["includes"]:
+            # Included templates could use any section of the printer state
+            context["printer"] = self.printer_state.materialise()
+        elif "printer" in compiled["variables"]:
+            context["printer"] = self.printer_state.materialise(
+                compiled["printer_fields"]
+            )
 
-        # If in doubt, just return nothing so the command remains unchanged.
-        return
+        providers = self.context_providers.names
+        if providers:
+            if not compiled["includes"]:
+                # Included templates could use any provider, otherwise only run the ones this template reads
+                providers = providers & compiled["variables"]
+            context.update(self.context_providers.resolve(providers, self._context_ttl))
+
+        return context
+
+    def register_context_provider(self, name, provider, ttl=None):
+        """
+        Make a value from another plugin available to macros, see docs/template_syntax.md. Also available to other
+        plugins through the plugin's helpers and the octoprint.plugin.gcode_macro.context_providers hook.
+        :param name: string, name of the variable in templates
+        :param provider: callable taking no arguments, returning the variable's value
+        :param ttl: float, seconds to reuse the value for, None to use the plugin's setting
+        :return: bool, whether the provider was registered
+        """
+        return self.context_providers.register(name, provider, ttl)
 
     def get_macro_content(self, command):
         try:
-            content = self.macros[command]["content"]
-        except KeyError as e:
-            # In theory this shouldn't happen with the check above, but if it does, I want to know
+            content = self.storage.read(command)
+        except StorageError as e:
+            # In theory this shouldn't happen, but if it does, I want to know
             self._logger.exception(e)
             content = ""
 
         return content
 
-    def render_with_jinja(self, command):
-        content = self.get_macro_content(command)
+    def load_macro_template(self, name):
+        """
+        Jinja loader function for macros, so they can share the bytecode cache with included files
+        :param name: string, template name, "@command" for macros
+        :return: tuple of (source, filename, uptodate), or None if it is not a macro
+        """
+        if not name.startswith(MACRO_TEMPLATE_PREFIX):
+            return None
+
+        command = name[len(MACRO_TEMPLATE_PREFIX) :]
+        if command not in self.macros:
+            return None
 
+        compiling = getattr(self._compiling, "macro", None)
+        if compiling is not None and compiling[0] == command:
+            content = compiling[1]
+        else:
+            content = self.get_macro_content(command)
+        digest = content_hash(content)
+
+        return (
+            content,
+            None,
+            lambda: command in self.macros and self.macros[command]["hash"] == digest,
+        )
+
+    def compile_macro(self, command, content=None):
+        """
+        Load a macro's content & compile its template, unless the cached one is still up to date with the content.
+        Static macros are not compiled, their commands are worked out once here instead.
+        :param command: string, macro to compile
+        :param content: string, the macro's content if it has already been read
+        :return: dict, compiled macro (see self._compiled), or None if it could not be compiled
+        """
+        if content is None:
+            content = self.get_macro_content(command)
+        digest = content_hash(content)
+
+        compiled = self._compiled.get(command)
+        if compiled is not None and compiled["hash"] == digest:
+            return compiled
+
+        if is_static(content):
+            commands = split_commands(content)
+            compiled = {
+                "hash": digest,
+                "size": len(content),
+                "flattened_size": 0,
+                "template": None,
+                "commands": commands,
+                "variables": frozenset(),
+                "cacheable": True,
+                "code": None,
+                "budgeted": False,
+                "printer_fields": frozenset(),
+                "includes": False,
+                "stateful": False,
+            }
+            self.store_compiled(command, compiled)
+            return compiled
+
+        start = time.perf_counter()
+        self._compiling.macro = (command, content)
         try:
-            template = self.jinja_env.from_string(content)
-            return template.render()
+            template = self.jinja_env.get_template(MACRO_TEMPLATE_PREFIX + command)
         except Exception as e:
+            # Errors are reported to the user when the macro is actually rendered
+            self._logger.warning(f"Could not compile macro {command}: {e}")
+            self.drop_compiled(command)
+            return None
+        finally:
+            self._compiling.macro = None
+
+        # Worked out when the macro was indexed, unless its content has changed since
+        macro = self.macros.get(command)
+        analysis = None
+        if macro is not None and macro["hash"] == digest:
+            analysis = macro["analysis"]
+        if analysis is None:
+            analysis = analyse_macro(content)
+            if macro is not None and macro["hash"] == digest:
+                macro["analysis"] = analysis
+
+        self.stats.record_compile(command, time.perf_counter() - start)
+
+        printer_fields = analysis["printer_fields"]
+        compiled = {
+            "hash": digest,
+            "size": len(content),
+            "flattened_size": 0,
+            "template": template,
+            "commands": None,
+            "variables": frozenset(analysis["variables"]),
+            "cacheable": analysis["cacheable"],
+            "code": None,
+            "budgeted": analysis["budgeted"],
+            "printer_fields": None
+            if printer_fields is None
+            else frozenset(printer_fields),
+            "includes": analysis["includes"],
+            "stateful": analysis["stateful"],
+        }
+        self.store_compiled(command, compiled)
+        return compiled
+
+    def get_template(self, command):
+        compiled = self._compiled.get(command)
+        if compiled is not None and compiled["template"] is not None:
+            return compiled["template"]
+
+        # Compiling failed when the macro was saved, try again so the error is raised & reported
+        return self.jinja_env.get_template(MACRO_TEMPLATE_PREFIX + command)
+
+    def render_with_jinja(self, command, context=None):
+        """
+        Render a macro's template
+        :param command: string, macro to render
+        :param context: dict, variables available to the template
+        :return: string, rendered content, or None if there was an error
+        """
+        try:
+            template = self.get_template(command)
+            if self._render_timeout > 0:
+                return self.render_worker.run(
+                    self._render_timeout,
+                    self.render_template,
+                    command,
+                    template,
+                    context,
+                )
+            return self.render_template(command, template, context)
+        except Exception as e:
+            self.report_render_error(command, e)
+            return None
+
+    def render_template(self, command, template, context):
+        if isinstance(self.jinja_env, BudgetedSandbox):
+            compiled = self._compiled.get(command)
+            # Templates that can't loop (checked when compiling) skip the loop budget, not the output limits
+            return self.jinja_env.render_budgeted(
+                template,
+                context or {},
+                loops=compiled is None or compiled["budgeted"],
+            )
+        return template.render(context or {})
+
+    def report_render_error(self, command, error):
+        self.stats.record_error(command)
+
+        if isinstance(
+            error,
+            (
+                RenderTimeout,
+                IsolatedRenderError,
+                SecurityError,
+                MacroArgumentError,
+                ContextProviderError,
+            ),
+        ):
+            # Nothing useful in the traceback, the message says what happened
             self._plugin_manager.send_plugin_message(
-                "gcode_macro", {"type": "rendering_error", "command": command}
+                "gcode_macro",
+                {"type": "rendering_error", "command": command, "reason": str(error)},
             )
-            self._logger.error(f"Error while rendering macro for {command}")
-            self._logger.exception(e)
-            return ""
+            self._logger.error(f"Error while rendering macro for {command}: {error}")
+            return
+
+        self._plugin_manager.send_plugin_message(
+            "gcode_macro", {"type": "rendering_error", "command": command}
+        )
+        self._logger.error(f"Error while rendering macro for {command}")
+        self._logger.exception(error)
+
+    # SimpleApiPlugin mixin
+    def on_api_get(self, request):
+        nodes = [
+            {
+                "command": command,
+                "calls": node["calls"],
+                "depth": node["depth"],
+                "cyclic": node["cyclic"],
+                "static": self.macros[command]["static"],
+                "flattened": self._flattened.get(command) is not None,
+            }
+            for command, node in self.call_graph.items()
+        ]
+        edges = [
+            [command, sub]
+            for command, node in self.call_graph.items()
+            for sub in node["calls"]
+        ]
+
+        return flask.jsonify(
+            {
+                "graph": {"nodes": nodes, "edges": edges, "cycles": self.call_cycles},
+                "stats": {
+                    "paths": self.render_counts,
+                    "macros": self.stats.as_dict(),
+                },
+            }
+        )
+
+    # StartupPlugin mixin
+    def on_after_startup(self):
+        # Other plugins are all initialized by now, and can provide context variables
+        self.load_context_providers()
+
+    def load_context_providers(self):
+        """
+        Register context providers from other plugins' octoprint.plugin.gcode_macro.context_providers hooks.
+        Hook handlers return a dict of name -> provider, or name -> (provider, ttl).
+        """
+        hooks = self._plugin_manager.get_hooks(
+            "octoprint.plugin.gcode_macro.context_providers"
+        )
+        for plugin, hook in hooks.items():
+            try:
+                providers = hook()
+            except Exception:
+                self._logger.exception(
+                    f"Error getting context providers from plugin {plugin}"
+                )
+                continue
+
+            for name, provider in providers.items():
+                ttl = None
+                if isinstance(provider, tuple):
+                    provider, ttl = provider
+                if self.context_providers.register(name, provider, ttl):
+                    self._logger.info(
+                        f"Registered context provider {name} from plugin {plugin}"
+                    )
+
+    # EventHandlerPlugin mixin
+    def on_event(self, event, payload):
+        if event == Events.POSITION_UPDATE:
+            self.printer_state.on_position_update(payload)
+        elif event == Events.DISCONNECTED:
+            self.printer_state.reset()
+
+    # ShutdownPlugin mixin
+    def on_shutdown(self):
+        self.macro_loader.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+        self._printer.unregister_callback(self.printer_state)
+        self.variables.shutdown()
+        self.render_worker.shutdown()
+        self.isolated_renderer.shutdown()
+        self.storage.close()
+
+    # BlueprintPlugin mixin
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        cache_sizes = {
+            "compiled": sum(
+                1 for compiled in self._compiled.values() if compiled["template"]
+            ),
+            "static": sum(
+                1 for compiled in self._compiled.values() if not compiled["template"]
+            ),
+            "flattened": sum(1 for commands in self._flattened.values() if commands),
+            "results": len(self._result_cache),
+        }
+        return flask.Response(
+            prometheus_metrics(self.stats, self.render_counts, cache_sizes),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    def is_blueprint_csrf_protected(self):
+        return True
 
     # Software update hook
     def get_update_information(self):
@@ -294,3 +1598,8 @@ def __plugin_load__():
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.gcode_queueing,
     }
+
+    global __plugin_helpers__
+    __plugin_helpers__ = {
+        "register_context_provider": __plugin_implementation__.register_context_provider,
+    }
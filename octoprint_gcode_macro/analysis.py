@@ -0,0 +1,69 @@
+from jinja2 import meta, nodes
+
+# Globals & filters that give a different result each time they are used
+NON_DETERMINISTIC_NAMES = frozenset(["random", "lipsum"])
+
+# Saved variables change outside of the template's context, and saving them has to happen on every render
+STATEFUL_NAMES = frozenset(["save_variable", "variables"])
+
+
+def analyse_template(ast):
+    """
+    Work out what a macro template depends on, from its parsed source
+    :param ast: jinja2.nodes.Template, from Environment.parse
+    :return: dict
+        variables: frozenset of names the template reads from its context
+        cacheable: bool, whether the same context always renders the same output
+        includes: bool, whether the template includes other templates, which can read any variable
+        stateful: bool, whether the template reads or saves persistent variables
+        printer_fields: frozenset of printer state sections the template reads, None if it could read any
+    """
+    variables = frozenset(meta.find_undeclared_variables(ast))
+
+    # Included templates can change without the macro changing, so always render those
+    includes = any(True for _ in meta.find_referenced_templates(ast))
+
+    non_deterministic = any(
+        node.name in NON_DETERMINISTIC_NAMES
+        for node in ast.find_all((nodes.Filter, nodes.Name))
+    )
+
+    # Globals are not undeclared variables, so look for the names themselves
+    stateful = any(node.name in STATEFUL_NAMES for node in ast.find_all(nodes.Name))
+
+    return {
+        "variables": variables,
+        "cacheable": not includes and not non_deterministic and not stateful,
+        "includes": includes,
+        "stateful": stateful,
+        "printer_fields": find_fields(ast, "printer")
+        if "printer" in variables
+        else frozenset(),
+    }
+
+
+def find_fields(ast, name):
+    """
+    Find the fields a template reads from a context variable, like printer.temperatures or printer["job"]
+    :param ast: jinja2.nodes.Template
+    :param name: string, variable name
+    :return: frozenset of field names, or None if the variable is used in a way that could read any field
+    """
+    fields = set()
+    accessed = set()
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        if isinstance(node.node, nodes.Name) and node.node.name == name:
+            if isinstance(node, nodes.Getattr):
+                fields.add(node.attr)
+            elif isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+                fields.add(node.arg.value)
+            else:
+                return None
+            accessed.add(id(node.node))
+
+    # Used as a whole somewhere, e.g. passed to a filter or assigned to another name
+    for node in ast.find_all(nodes.Name):
+        if node.name == name and node.ctx == "load" and id(node) not in accessed:
+            return None
+
+    return frozenset(fields)
@@ -0,0 +1,72 @@
+import os
+
+# Suffix of files being written, renamed into place once complete
+TEMP_SUFFIX = ".tmp"
+
+# Syncs a file's data & size without its other metadata, where the OS can
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def fsync_directory(path):
+    """
+    Make renames & deletions in a directory durable
+    :param path: string, directory
+    """
+    if not hasattr(os, "O_DIRECTORY"):
+        # Not possible (or needed) on Windows
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files(folder, files, sync=True):
+    """
+    Write a batch of files so each one either has its old or its new content after a crash, never part of it.
+    Files are written to temporary names & synced to disk, then renamed over the originals, with one sync of the
+    directory at the end rather than one per file. Only the files being written are synced, not the whole system,
+    so saving doesn't wait on anything else being written at the time, like an upload.
+    :param folder: string, directory to write to
+    :param files: dict, filename -> content
+    :param sync: bool, False to skip syncing for files that can be rebuilt, which are still replaced atomically
+    :return: int, bytes written
+    """
+    written = 0
+    temp_paths = []
+    try:
+        for name, content in files.items():
+            data = content.encode("utf-8")
+            temp_path = os.path.join(folder, name + TEMP_SUFFIX)
+            temp_paths.append((temp_path, os.path.join(folder, name)))
+            with open(temp_path, "wb") as f:
+                f.write(data)
+                if sync:
+                    f.flush()
+                    fdatasync(f.fileno())
+            written += len(data)
+
+        for temp_path, path in temp_paths:
+            os.replace(temp_path, path)
+    finally:
+        # Anything not renamed into place is left over from an error
+        for temp_path, _ in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    if sync:
+        fsync_directory(folder)
+    return written
+
+
+def remove_stale_temp_files(folder):
+    """
+    Remove temporary files left behind by a write that was interrupted
+    :param folder: string, directory to clean up
+    """
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.name.endswith(TEMP_SUFFIX):
+            os.remove(entry.path)
@@ -0,0 +1,62 @@
+from collections import deque
+
+
+def analyse_call_graph(calls):
+    """
+    Work out how deep each macro's tree of sub-macros goes, and find any circular macros
+    :param calls: dict, command -> set of macro commands it calls
+    :return: tuple of (order, depths, cycles)
+        order: list, acyclic commands ordered so every macro comes after the macros it calls
+        depths: dict, command -> number of levels of sub-macros below it, None if it is/calls a circular macro
+        cycles: list, sorted lists of commands calling each other in a circle
+    """
+    callers = {command: set() for command in calls}
+    remaining = {}
+    for command, called in calls.items():
+        remaining[command] = len(called)
+        for sub in called:
+            callers[sub].add(command)
+
+    # Peel off macros that call nothing left in the graph, anything that remains is part of or calls a cycle
+    queue = deque(command for command, count in remaining.items() if count == 0)
+    order = []
+    depths = {}
+    while queue:
+        command = queue.popleft()
+        order.append(command)
+        depths[command] = max((depths[sub] + 1 for sub in calls[command]), default=0)
+        for caller in callers[command]:
+            remaining[caller] -= 1
+            if remaining[caller] == 0:
+                queue.append(caller)
+
+    cyclic = [command for command in calls if command not in depths]
+    for command in cyclic:
+        depths[command] = None
+
+    # Group what's left into strongly connected components - the graphs are small, reachability is fine
+    reachable = {command: _reachable(calls, command) for command in cyclic}
+    cycles = []
+    seen = set()
+    for command in cyclic:
+        if command in seen or command not in reachable[command]:
+            # Not part of a cycle itself, just calls into one
+            continue
+        component = sorted(
+            sub for sub in reachable[command] if command in reachable.get(sub, ())
+        )
+        seen.update(component)
+        cycles.append(component)
+
+    return order, depths, cycles
+
+
+def _reachable(calls, start):
+    found = set()
+    queue = deque(calls[start])
+    while queue:
+        command = queue.popleft()
+        if command not in found:
+            found.add(command)
+            queue.extend(calls[command])
+    return found
@@ -0,0 +1,84 @@
+import hashlib
+
+from jinja2 import Environment, TemplateError
+
+from octoprint_gcode_macro.analysis import analyse_template
+from octoprint_gcode_macro.gcode import split_commands
+from octoprint_gcode_macro.sandbox import needs_budget
+
+# Any of these in a macro's content means it needs rendering with Jinja
+JINJA_MARKERS = ("{{", "{%", "{#")
+
+# Extensions of the plugin's Jinja environment, which templates are parsed with
+JINJA_EXTENSIONS = ("jinja2.ext.do",)
+
+# What is kept about each macro without its content, see index_entry
+INDEX_FIELDS = ("size", "mtime", "hash", "references", "static", "analysis")
+
+# Parsing doesn't depend on anything else about the environment, including whether it is sandboxed
+_parser = Environment(extensions=JINJA_EXTENSIONS)
+
+
+def is_static(content):
+    """
+    Whether a macro is plain gcode, with nothing for Jinja to do
+    :param content: string, macro content
+    :return: bool
+    """
+    return not any(marker in content for marker in JINJA_MARKERS)
+
+
+def content_hash(content):
+    """
+    Hash of a macro's content, used to tell whether a compiled template is still valid
+    :param content: string, macro content
+    :return: string, hex digest
+    """
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def index_entry(content, size, mtime):
+    """
+    Everything the plugin needs to know about a macro without holding its content
+    :param content: string, macro content
+    :param size: int, size of the stored macro in bytes
+    :param mtime: int, time the macro was stored in ns, None if it is not known
+    :return: dict
+    """
+    return {
+        "size": size,
+        "mtime": mtime,
+        "hash": content_hash(content),
+        # Only @ commands written out literally can be found, not ones generated by the template
+        "references": [cmd for cmd in split_commands(content) if cmd.startswith("@")],
+        "static": is_static(content),
+        "analysis": analyse_macro(content),
+    }
+
+
+def analyse_macro(content):
+    """
+    Work out what a macro's template depends on, once when it is indexed. Analysing a template takes about as long as
+    compiling it, so this way loading it later, maybe from the bytecode cache, doesn't have to do it again.
+    :param content: string, macro content
+    :return: dict, see analyse_template, plus whether it needs a budget in the sandbox. Sets are sorted lists, so it
+        can be stored as JSON. None for static macros & templates that can't be parsed, which is reported when they
+        are rendered.
+    """
+    if is_static(content):
+        return None
+    try:
+        ast = _parser.parse(content)
+    except TemplateError:
+        return None
+
+    analysis = analyse_template(ast)
+    printer_fields = analysis["printer_fields"]
+    return {
+        "variables": sorted(analysis["variables"]),
+        "cacheable": analysis["cacheable"],
+        "includes": analysis["includes"],
+        "stateful": analysis["stateful"],
+        "printer_fields": None if printer_fields is None else sorted(printer_fields),
+        "budgeted": needs_budget(ast),
+    }
@@ -0,0 +1,145 @@
+import marshal
+import multiprocessing
+import threading
+
+from jinja2 import Environment, FileSystemLoader
+
+from octoprint_gcode_macro.gcode import split_commands
+from octoprint_gcode_macro.sandbox import BudgetedSandbox
+from octoprint_gcode_macro.worker import RenderTimeout
+
+
+class IsolatedRenderError(Exception):
+    pass
+
+
+def _serve(connection, search_path, sandbox):
+    """
+    Worker process main loop. Receives compiled templates & their context, sends back the rendered commands.
+    """
+    if sandbox["enabled"]:
+        environment = BudgetedSandbox(
+            loader=FileSystemLoader(search_path),
+            max_loop_iterations=sandbox["max_loop_iterations"],
+            max_output_bytes=sandbox["max_output_bytes"],
+            max_output_lines=sandbox["max_output_lines"],
+        )
+        render = environment.render_budgeted
+    else:
+        environment = Environment(loader=FileSystemLoader(search_path))
+        render = environment.template_class.render
+    templates = {}
+
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+
+        name, digest, code, context = request
+        try:
+            cached = templates.get(name)
+            if cached is None or cached[0] != digest:
+                template = environment.template_class.from_code(
+                    environment, marshal.loads(code), environment.make_globals(None)
+                )
+                cached = templates[name] = (digest, template)
+
+            connection.send((True, split_commands(render(cached[1], context))))
+        except Exception as e:
+            connection.send((False, f"{type(e).__name__}: {e}"))
+
+
+class IsolatedRenderer:
+    """
+    Renders templates in a separate, warm process so CPU-heavy macros don't hold the GIL that OctoPrint's web
+    server & comm thread need. Unlike a thread, the process can be killed when a render takes too long.
+    """
+
+    def __init__(self, search_path):
+        self._search_path = search_path
+        self._sandbox = {"enabled": False}
+        self._lock = threading.Lock()
+        self._process = None
+        self._connection = None
+
+    def configure(self, sandbox):
+        """
+        Set the sandbox options templates are compiled for, restarting the worker process if needed
+        :param sandbox: dict, sandbox settings
+        """
+        with self._lock:
+            self._sandbox = dict(sandbox)
+            if self._process is not None:
+                self._stop()
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self._connection, child = context.Pipe()
+        self._process = context.Process(
+            target=_serve,
+            args=(child, self._search_path, self._sandbox),
+            name="gcode_macro.isolated",
+            daemon=True,
+        )
+        self._process.start()
+        child.close()
+
+    def _stop(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._connection.close()
+        self._process = None
+        self._connection = None
+
+    def warm_up(self):
+        """
+        Start the worker process ahead of the first render, if it is not already running
+        """
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+
+    def render(self, name, digest, code, context, timeout=None):
+        """
+        Render a template in the worker process
+        :param name: string, template name
+        :param digest: string, content hash, the worker recreates its template when this changes
+        :param code: bytes, marshalled code object from Environment.compile
+        :param context: dict, template context, must be picklable
+        :param timeout: float, seconds to wait for the result, None to wait forever
+        :return: tuple, rendered commands with comments & whitespace stripped
+        :raises RenderTimeout: if the render did not finish in time
+        :raises IsolatedRenderError: if the template raised an error
+        """
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+
+            try:
+                self._connection.send((name, digest, code, context))
+                if not self._connection.poll(timeout):
+                    # Kill it, the next render gets a fresh process
+                    self._stop()
+                    raise RenderTimeout(f"Rendering did not finish within {timeout}s")
+                success, result = self._connection.recv()
+            except (EOFError, OSError) as e:
+                self._stop()
+                raise IsolatedRenderError(f"Render process died: {e}") from e
+
+        if not success:
+            raise IsolatedRenderError(result)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            if self._connection is not None:
+                try:
+                    self._connection.send(None)
+                    self._process.join(1)
+                except OSError:
+                    pass
+            self._stop()
@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
+
+
+class MacroLoader:
+    """
+    Loads macros on a small thread pool in the background, so OctoPrint can carry on starting up while files are
+    read from a slow SD card. Anything that needs a macro before then only waits for that one.
+    """
+
+    def __init__(self, load, name="gcode_macro.loader"):
+        """
+        :param load: callable, loads a single macro given its command
+        :param name: string, prefix for the pool's thread names
+        """
+        self._load = load
+        self._name = name
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = {}
+
+    def start(self, commands, threads, done=None):
+        """
+        Start loading macros, stopping any loading that's still going on
+        :param commands: iterable of macros to load, in order
+        :param threads: int, number of threads to load with
+        :param done: callable, called from a background thread once everything is loaded
+        """
+        self.stop()
+        with self._lock:
+            executor = self._executor = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix=self._name
+            )
+            futures = self._futures = {
+                command: executor.submit(self._load, command) for command in commands
+            }
+
+        def finish():
+            wait_for_futures(futures.values())
+            if self._futures is not futures:
+                # Stopped, or started again in the meantime
+                return
+            if done is not None:
+                done()
+            with self._lock:
+                if self._futures is futures:
+                    self._futures = {}
+                    self._executor = None
+            executor.shutdown(wait=False)
+
+        threading.Thread(target=finish, name=self._name + ".done", daemon=True).start()
+
+    def wait(self, command):
+        """
+        Make sure a macro has been loaded, if it is being loaded in the background. If it hasn't started yet it's
+        taken off the queue & loaded straight away, rather than waiting for the macros ahead of it.
+        :param command: string, macro that's needed now
+        """
+        future = self._futures.get(command)
+        if future is None:
+            return
+        if future.cancel():
+            self._load(command)
+            return
+        try:
+            future.result()
+        except Exception:
+            # Logged by the load function, the caller tries again & reports it
+            pass
+
+    @property
+    def loading(self):
+        # Still true while the done callback runs
+        return bool(self._futures)
+
+    def stop(self):
+        """
+        Cancel loading macros that haven't started, the ones being loaded are left to finish
+        """
+        with self._lock:
+            futures, self._futures = self._futures, {}
+            executor, self._executor = self._executor, None
+        for future in futures.values():
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
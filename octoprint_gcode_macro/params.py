@@ -0,0 +1,202 @@
+import re
+from functools import lru_cache
+
+# KEY=VALUE pairs after the macro's command, values can be "quoted" to include spaces
+ARGUMENT = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)=("(?:[^"\\]|\\.)*"|\S*)')
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+FALSE_VALUES = ("0", "false", "no", "off")
+
+
+class MacroArgumentError(Exception):
+    pass
+
+
+@lru_cache(maxsize=1024)
+def parse_arguments(text):
+    """
+    Parse the KEY=VALUE arguments a macro was called with. Keys are case-insensitive, and made upper case.
+    The same arguments are often sent repeatedly, so results are cached.
+    :param text: string, everything after the macro's command
+    :return: tuple of (key, value) pairs, values are strings
+    """
+    return tuple(
+        (
+            key.upper(),
+            value[1:-1].replace('\\"', '"') if value.startswith('"') else value,
+        )
+        for key, value in ARGUMENT.findall(text)
+    )
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in TRUE_VALUES:
+        return True
+    if str(value).lower() in FALSE_VALUES:
+        return False
+    raise ValueError(value)
+
+
+# Parameter types that can be declared, and how to convert a value to each
+CONVERTERS = {
+    "int": int,
+    "float": float,
+    "bool": to_bool,
+    "string": str,
+}
+
+
+def infer_type(value):
+    """
+    Guess a parameter's type from its default value, for parameters declared without one
+    :param value: default value, usually a string from the settings
+    :return: string, one of CONVERTERS
+    """
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if not isinstance(value, str) or value == "":
+        return "string"
+
+    if value.lower() in ("true", "false"):
+        return "bool"
+    for kind in ("int", "float"):
+        try:
+            CONVERTERS[kind](value)
+            return kind
+        except ValueError:
+            pass
+    return "string"
+
+
+def normalize_parameters(parameters):
+    """
+    Validate & clean up parameter declarations from the settings: upper case names, known types, defaults & limits
+    converted to the parameter's type. An empty default makes the parameter required.
+    :param parameters: list of dicts with name, and optionally type, default, min & max
+    :return: tuple of (list of valid declarations, list of error messages for invalid ones, which are dropped)
+    """
+    result = []
+    errors = []
+    for parameter in parameters:
+        name = str(parameter.get("name") or "").strip().upper()
+        if not name:
+            continue
+
+        default = parameter.get("default")
+        kind = parameter.get("type") or infer_type(default)
+        if kind not in CONVERTERS:
+            errors.append(f"{name}: unknown type {kind}")
+            continue
+        convert = CONVERTERS[kind]
+
+        try:
+            if default is None or default == "":
+                default = None
+            else:
+                default = convert(default)
+
+            minimum = parameter.get("min")
+            maximum = parameter.get("max")
+            if kind in ("int", "float"):
+                minimum = None if minimum is None or minimum == "" else convert(minimum)
+                maximum = None if maximum is None or maximum == "" else convert(maximum)
+            else:
+                minimum = maximum = None
+        except ValueError as e:
+            errors.append(f"{name}: {e}")
+            continue
+
+        if minimum is not None and maximum is not None and minimum > maximum:
+            errors.append(f"{name}: minimum {minimum} is above maximum {maximum}")
+            continue
+        if default is not None and (
+            (minimum is not None and default < minimum)
+            or (maximum is not None and default > maximum)
+        ):
+            errors.append(f"{name}: default {default} is outside of its limits")
+            continue
+
+        result.append(
+            {
+                "name": name,
+                "type": kind,
+                "default": default,
+                "min": minimum,
+                "max": maximum,
+            }
+        )
+
+    return result, errors
+
+
+class ParameterSchema:
+    """
+    A macro's parameter declarations compiled into a validator, built once when macros are saved or loaded so
+    rendering only has to look each argument up.
+    """
+
+    __slots__ = ("defaults", "checks", "required")
+
+    def __init__(self, parameters):
+        self.defaults = {}
+        self.checks = {}
+        self.required = frozenset(
+            parameter["name"]
+            for parameter in parameters
+            if parameter["default"] is None
+        )
+        for parameter in parameters:
+            self.checks[parameter["name"]] = (
+                parameter["type"],
+                CONVERTERS[parameter["type"]],
+                parameter["min"],
+                parameter["max"],
+            )
+            if parameter["default"] is not None:
+                self.defaults[parameter["name"]] = parameter["default"]
+
+    def __call__(self, arguments):
+        """
+        Validate the arguments a macro was called with
+        :param arguments: string, KEY=VALUE arguments
+        :return: dict, parameter name -> value, declared defaults filled in, undeclared parameters as strings
+        :raises MacroArgumentError: if an argument is invalid, or a required one is missing
+        """
+        params = dict(self.defaults)
+        for name, value in parse_arguments(arguments):
+            check = self.checks.get(name)
+            if check is None:
+                params[name] = value
+                continue
+
+            kind, convert, minimum, maximum = check
+            try:
+                value = convert(value)
+            except ValueError:
+                raise MacroArgumentError(
+                    f"Parameter {name} should be {kind}, got {value!r}"
+                ) from None
+            if minimum is not None and value < minimum:
+                raise MacroArgumentError(
+                    f"Parameter {name} should be at least {minimum}, got {value}"
+                )
+            if maximum is not None and value > maximum:
+                raise MacroArgumentError(
+                    f"Parameter {name} should be at most {maximum}, got {value}"
+                )
+            params[name] = value
+
+        if self.required:
+            missing = self.required - params.keys()
+            if missing:
+                raise MacroArgumentError(
+                    "Missing required parameters: " + ", ".join(sorted(missing))
+                )
+
+        return params
@@ -0,0 +1,91 @@
+import threading
+import time
+
+# Context variables set by the plugin itself, which providers can't replace
+RESERVED_NAMES = frozenset(["params", "printer"])
+
+
+class ContextProviderError(Exception):
+    pass
+
+
+class ContextProviders:
+    """
+    Context variables supplied by other plugins. A provider is only called when a template being rendered uses its
+    name, and its result is reused until its time to live runs out, so macros that don't need an expensive value
+    never pay for it.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._providers = {}
+        # Cached results, name -> (expiry time, value)
+        self._values = {}
+        # Names of registered providers, checked against each template's variables while rendering
+        self.names = frozenset()
+
+    def register(self, name, provider, ttl=None):
+        """
+        Register a context provider
+        :param name: string, name of the variable in templates
+        :param provider: callable taking no arguments, returning the variable's value
+        :param ttl: float, seconds to reuse the value for, None to use the plugin's setting
+        :return: bool, whether the provider was registered
+        """
+        if name in RESERVED_NAMES or not name.isidentifier():
+            self._logger.warning(f"Can't register a context provider named {name}")
+            return False
+        if not callable(provider):
+            self._logger.warning(f"Context provider {name} is not callable")
+            return False
+
+        with self._lock:
+            self._providers[name] = {"provider": provider, "ttl": ttl}
+            self._values.pop(name, None)
+            self.names = frozenset(self._providers)
+        return True
+
+    def unregister(self, name):
+        with self._lock:
+            self._providers.pop(name, None)
+            self._values.pop(name, None)
+            self.names = frozenset(self._providers)
+
+    def resolve(self, names, default_ttl):
+        """
+        Get the values of some providers, calling them only if their cached value has expired
+        :param names: iterable of provider names
+        :param default_ttl: float, seconds to reuse values for providers that didn't set their own
+        :return: dict, name -> value
+        :raises ContextProviderError: if a provider failed
+        """
+        now = time.monotonic()
+        result = {}
+        for name in names:
+            registration = self._providers.get(name)
+            if registration is None:
+                continue
+
+            cached = self._values.get(name)
+            if cached is not None and cached[0] > now:
+                result[name] = cached[1]
+                continue
+
+            try:
+                value = registration["provider"]()
+            except Exception as e:
+                raise ContextProviderError(
+                    f"Context provider {name} failed: {type(e).__name__}: {e}"
+                ) from e
+
+            ttl = (
+                registration["ttl"] if registration["ttl"] is not None else default_ttl
+            )
+            if ttl > 0:
+                with self._lock:
+                    if name in self._providers:
+                        self._values[name] = (now + ttl, value)
+            result[name] = value
+
+        return result
@@ -0,0 +1,300 @@
+import operator
+import re
+import threading
+
+from jinja2 import filters, nodes
+from jinja2.compiler import CodeGenerator
+from jinja2.runtime import LoopContext
+from jinja2.sandbox import SandboxedEnvironment, SecurityError
+
+
+class BudgetExceeded(SecurityError):
+    pass
+
+
+# Operators that can build huge values from small templates, checked before they run
+BUDGETED_BINOPS = frozenset(["*", "**", "%"])
+
+# Part of the bytecode cache folder, changed whenever the sandbox compiles templates differently
+SANDBOX_CODE_VERSION = 2
+
+# String methods that pad to a width given by the template
+PADDING_METHODS = frozenset(["center", "ljust", "rjust", "zfill", "expandtabs"])
+
+# printf-style conversions, capturing the width, precision & conversion type
+FORMAT_CONVERSION = re.compile(
+    r"%(?:\([^)]*\))?[-#0 +]*(\*|\d+)?(?:\.(\*|\d+))?[hlL]?(.)"
+)
+
+
+class BudgetedRange:
+    """
+    range() for templates. It is charged to the loop budget every time it's iterated, rather than once when it's
+    created, so a range looped over again in a nested loop is paid for on every pass.
+    """
+
+    __slots__ = ("_range", "_spend")
+
+    def __init__(self, rng, spend):
+        self._range = rng
+        self._spend = spend
+
+    def __iter__(self):
+        self._spend(len(self._range))
+        return iter(self._range)
+
+    def __reversed__(self):
+        self._spend(len(self._range))
+        return reversed(self._range)
+
+    def __len__(self):
+        return len(self._range)
+
+    def __contains__(self, item):
+        return item in self._range
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return BudgetedRange(self._range[index], self._spend)
+        return self._range[index]
+
+    def __eq__(self, other):
+        if isinstance(other, BudgetedRange):
+            other = other._range
+        return self._range == other
+
+    def __hash__(self):
+        return hash(self._range)
+
+    def __repr__(self):
+        return repr(self._range)
+
+
+class BudgetedCodeGenerator(CodeGenerator):
+    """
+    Compiles every {% for %} loop to iterate through BudgetedSandbox.budgeted_loop, so each pass is charged
+    """
+
+    def visit_For(self, node, frame):
+        budgeted_iter = nodes.Call(
+            nodes.EnvironmentAttribute("budgeted_loop"),
+            [node.iter],
+            [],
+            None,
+            None,
+            lineno=node.iter.lineno,
+        )
+        super().visit_For(
+            nodes.For(
+                node.target,
+                budgeted_iter,
+                node.body,
+                node.else_,
+                node.test,
+                node.recursive,
+                lineno=node.lineno,
+            ),
+            frame,
+        )
+
+
+class BudgetedSandbox(SandboxedEnvironment):
+    """
+    Sandboxed Jinja environment that also limits how much work a template can do while it renders: iterations
+    of loops & ranges, the size of sequences built with * and **, and the amount of output. Widths given to %
+    formats & padding filters are checked against the output limit before the padded string is built.
+    """
+
+    intercepted_binops = BUDGETED_BINOPS
+    code_generator_class = BudgetedCodeGenerator
+
+    def __init__(
+        self, *args, max_loop_iterations, max_output_bytes, max_output_lines, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_loop_iterations = max_loop_iterations
+        self.max_output_bytes = max_output_bytes
+        self.max_output_lines = max_output_lines
+
+        # Iterations left for the render running on each thread
+        self._budget = threading.local()
+        self.globals["range"] = self.budgeted_range
+        self.filters["center"] = self.budgeted_center
+        self.filters["indent"] = self.budgeted_indent
+        self.filters["format"] = self.budgeted_format
+
+    def _spend(self, iterations):
+        remaining = getattr(self._budget, "iterations", self.max_loop_iterations)
+        remaining -= iterations
+        if remaining < 0:
+            raise BudgetExceeded(
+                f"Template exceeded the limit of {self.max_loop_iterations} loop iterations"
+            )
+        self._budget.iterations = remaining
+
+    def budgeted_range(self, *args):
+        return BudgetedRange(range(*args), self._spend)
+
+    def budgeted_loop(self, iterable):
+        """
+        Charge a pass of a {% for %} loop to the budget
+        :param iterable: what the loop iterates over
+        :return: iterable to loop over instead
+        """
+        if isinstance(iterable, BudgetedRange):
+            # Charged when iterated
+            return iterable
+        try:
+            # Charge for the whole pass up front, so looping over a huge sequence fails straight away
+            self._spend(len(iterable))
+            return iterable
+        except TypeError:
+            return self._spend_per_item(iterable)
+
+    def _spend_per_item(self, iterable):
+        for item in iterable:
+            self._spend(1)
+            yield item
+
+    def _check_width(self, width):
+        if isinstance(width, int) and abs(width) > self.max_output_bytes:
+            raise BudgetExceeded(
+                f"Template tried to pad to {width} bytes, over the output limit of {self.max_output_bytes} bytes"
+            )
+
+    def _check_format(self, template, args):
+        """
+        Check the widths & precisions of a printf-style format before it's applied
+        :param template: string, format
+        :param args: right hand side of the %, a single value, tuple or mapping
+        :raises BudgetExceeded: if the formatted string could be longer than the output limit
+        """
+        values = iter(args if isinstance(args, tuple) else (args,))
+        width = len(template)
+        for field_width, precision, conversion in FORMAT_CONVERSION.findall(template):
+            fields = [field_width]
+            if conversion not in "sra":
+                # Precision can only shorten strings, but pads numbers with digits
+                fields.append(precision)
+            elif precision == "*":
+                next(values, None)
+            for field in fields:
+                if field == "*":
+                    field = next(values, 0)
+                elif field:
+                    field = int(field)
+                if isinstance(field, int):
+                    width += abs(field)
+            if conversion != "%":
+                next(values, None)
+        self._check_width(width)
+
+    def budgeted_center(self, value, width=80):
+        self._check_width(width)
+        return filters.do_center(value, width)
+
+    def budgeted_indent(self, s, width=4, first=False, blank=False):
+        if isinstance(width, int):
+            self._check_width(width * (str(s).count("\n") + 1))
+        elif isinstance(width, str):
+            self._check_width(len(width) * (str(s).count("\n") + 1))
+        return filters.do_indent(s, width, first, blank)
+
+    def budgeted_format(self, value, *args, **kwargs):
+        if not kwargs:
+            self._check_format(str(value), args)
+        return filters.do_format(value, *args, **kwargs)
+
+    def call(__self, __context, __obj, *args, **kwargs):  # noqa: B902
+        if isinstance(__obj, LoopContext) and args:
+            # Recursive loops iterate through loop(), rather than the {% for %} compiled with the budget
+            args = (__self.budgeted_loop(args[0]), *args[1:])
+        elif (
+            getattr(__obj, "__name__", None) in PADDING_METHODS
+            and isinstance(getattr(__obj, "__self__", None), str)
+            and args
+        ):
+            __self._check_width(args[0])
+        return super().call(__context, __obj, *args, **kwargs)
+
+    def call_binop(self, context, operator_name, left, right):
+        if operator_name == "**":
+            if (
+                isinstance(left, (int, float))
+                and isinstance(right, (int, float))
+                and abs(left) > 1
+                and right > 64
+            ):
+                raise BudgetExceeded("Template tried to raise a number to a huge power")
+            return operator.pow(left, right)
+
+        if operator_name == "*":
+            for sequence, times in ((left, right), (right, left)):
+                if isinstance(sequence, (str, list, tuple)) and isinstance(times, int):
+                    self._spend(len(sequence) * max(times, 0))
+            return operator.mul(left, right)
+
+        if operator_name == "%":
+            if isinstance(left, str):
+                self._check_format(left, right)
+            return operator.mod(left, right)
+
+        return super().call_binop(context, operator_name, left, right)
+
+    def render_budgeted(self, template, context, loops=True):
+        """
+        Render a template, enforcing the output limits as the output is generated
+        :param template: jinja2.Template from this environment
+        :param context: dict, template context
+        :param loops: bool, whether the template can loop & needs a fresh loop budget, see needs_budget. The output
+            limits apply either way, a single filter or % can produce any amount of output.
+        :return: string, rendered output
+        :raises BudgetExceeded: if the template goes over any of the limits
+        """
+        if loops:
+            self._budget.iterations = self.max_loop_iterations
+        try:
+            output = []
+            size = 0
+            lines = 0
+            for chunk in template.generate(context):
+                size += len(chunk)
+                lines += chunk.count("\n")
+                if size > self.max_output_bytes:
+                    raise BudgetExceeded(
+                        f"Template exceeded the output limit of {self.max_output_bytes} bytes"
+                    )
+                if lines > self.max_output_lines:
+                    raise BudgetExceeded(
+                        f"Template exceeded the output limit of {self.max_output_lines} lines"
+                    )
+                output.append(chunk)
+            return "".join(output)
+        finally:
+            if loops:
+                del self._budget.iterations
+
+
+def needs_budget(ast):
+    """
+    Whether a template can loop or build huge sequences. Templates without loops, calls, includes or the budgeted
+    operators are rendered without resetting the loop budget, their output is still limited.
+    :param ast: jinja2.nodes.Template, from Environment.parse
+    :return: bool
+    """
+    return any(
+        True
+        for _ in ast.find_all(
+            (
+                nodes.For,
+                nodes.Call,
+                nodes.Include,
+                nodes.Import,
+                nodes.FromImport,
+                nodes.Extends,
+                nodes.Macro,
+                nodes.Mul,
+                nodes.Pow,
+            )
+        )
+    )
@@ -0,0 +1,72 @@
+import threading
+
+from octoprint.printer import PrinterCallback
+
+# Sections of the printer state available to templates as printer.<section>
+PRINTER_STATE_FIELDS = (
+    "state",
+    "temperatures",
+    "position",
+    "job",
+    "progress",
+    "offsets",
+)
+
+
+class PrinterStateSnapshot(PrinterCallback):
+    """
+    Copy of the printer's state, kept up to date from OctoPrint's printer callbacks & events so rendering a macro
+    never has to ask the printer. Each section is replaced as a whole when it changes and never modified in place,
+    so templates can be given the sections themselves without copying them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def update(self, **sections):
+        with self._lock:
+            self._sections = {**self._sections, **sections}
+
+    def reset(self):
+        # Sections start empty rather than missing, so templates can test printer.job.file before there is any data
+        with self._lock:
+            self._sections = {field: {} for field in PRINTER_STATE_FIELDS}
+
+    def materialise(self, fields=None):
+        """
+        Build the printer state for a template
+        :param fields: iterable of sections the template uses, None for all of them
+        :return: dict, section -> value
+        """
+        sections = self._sections
+        if fields is None:
+            return dict(sections)
+        return {field: sections[field] for field in fields if field in sections}
+
+    # PrinterCallback
+    def on_printer_send_initial_data(self, data):
+        self.on_printer_send_current_data(data)
+
+    def on_printer_send_current_data(self, data):
+        sections = {}
+        for field in ("state", "job", "progress", "offsets"):
+            if data.get(field) is not None:
+                sections[field] = data[field]
+        self.update(**sections)
+
+    def on_printer_add_temperature(self, data):
+        self.update(
+            temperatures={
+                heater: {"actual": values.get("actual"), "target": values.get("target")}
+                for heater, values in data.items()
+                if isinstance(values, dict)
+            }
+        )
+
+    def on_position_update(self, payload):
+        self.update(
+            position={
+                axis: payload.get(axis) for axis in ("x", "y", "z", "e", "t", "f")
+            }
+        )
@@ -20,6 +20,72 @@ $(function () {
     });
     self.newMacroName = ko.observable("");
 
+    // Call graph of macros & render statistics, from the plugin's API
+    self.callGraph = ko.observable({});
+    self.renderStats = ko.observableArray([]);
+
+    self.requestCallGraph = () => {
+      OctoPrint.simpleApiGet("gcode_macro").done((response) => {
+        const nodes = {};
+        response.graph.nodes.forEach((node) => {
+          nodes[node.command] = node;
+        });
+        self.callGraph(nodes);
+
+        self.renderStats(
+          Object.entries(response.stats.macros).map(([command, stats]) => ({
+            command: command,
+            invocations: stats.invocations,
+            renderTimeAvg: (stats.render_time_avg * 1000).toFixed(2),
+            renderTimeMax: (stats.render_time_max * 1000).toFixed(2),
+            compileTime: (stats.compile_time * 1000).toFixed(2),
+            lines: stats.lines,
+            depthMax: stats.depth_max,
+            cacheHitRate:
+              stats.cache_hit_rate === null
+                ? "-"
+                : (stats.cache_hit_rate * 100).toFixed(0) + "%",
+            resultCacheHitRate:
+              stats.result_cache_hit_rate === null
+                ? "-"
+                : (stats.result_cache_hit_rate * 100).toFixed(0) + "%",
+          }))
+        );
+      });
+    };
+
+    self.macroCalls = (command) => {
+      const node = self.callGraph()[command];
+      return node ? node.calls.map((sub) => "@" + sub).join(", ") : "";
+    };
+
+    self.macroParameters = (macro) =>
+      macro
+        .parameters()
+        .map((parameter) => {
+          const value = (key) => ko.unwrap(parameter[key]);
+          let details = [value("type") || "string"];
+          if (value("default") === null || value("default") === "") {
+            details.push("required");
+          } else {
+            details.push(value("default"));
+          }
+          if (value("min") !== null || value("max") !== null) {
+            details.push(
+              (value("min") === null ? "" : value("min")) +
+                "–" +
+                (value("max") === null ? "" : value("max"))
+            );
+          }
+          return value("name") + " (" + details.join(", ") + ")";
+        })
+        .join(", ");
+
+    self.isMacroCyclic = (command) => {
+      const node = self.callGraph()[command];
+      return node ? node.cyclic : false;
+    };
+
     self.allMacroNames = () => {
       if (self.settings.settings) {
         // Settings are not defined on binding, only after settings fetch
@@ -40,6 +106,9 @@ $(function () {
         command: ko.observable(self.newMacroName()),
         content: ko.observable(""),
         description: ko.observable(""),
+        cache_result: ko.observable(true),
+        isolated: ko.observable(false),
+        parameters: ko.observableArray([]),
       });
       self.settings.settings.plugins.gcode_macro.macros.push(
         self.selectedMacro()
@@ -53,6 +122,20 @@ $(function () {
       $("#gcodeMacroEditor").modal("show");
     };
 
+    self.addParameter = () => {
+      self.selectedMacro().parameters.push({
+        name: ko.observable(""),
+        type: ko.observable("string"),
+        default: ko.observable(""),
+        min: ko.observable(null),
+        max: ko.observable(null),
+      });
+    };
+
+    self.removeParameter = (parameter) => {
+      self.selectedMacro().parameters.remove(parameter);
+    };
+
     self.deleteMacro = (data) => {
       self.settings.settings.plugins.gcode_macro.macros.remove(data);
     };
@@ -69,13 +152,46 @@ $(function () {
       return !macros.includes(self.newMacroName());
     });
 
+    self.onSettingsShown = () => {
+      self.requestCallGraph();
+    };
+
+    self.onEventSettingsUpdated = () => {
+      self.requestCallGraph();
+    };
+
     self.onDataUpdaterPluginMessage = function (plugin, data) {
       if (plugin !== "gcode_macro") return;
+      if (data.type === "circular_macros") {
+        new PNotify({
+          title: "Circular macros found",
+          text:
+            "These macros call each other in a circle, and will stop rendering at the nesting limit: " +
+            data.cycles
+              .map((cycle) =>
+                cycle.map((command) => "<code>@" + command + "</code>").join(", ")
+              )
+              .join("; "),
+          type: "warning",
+          hide: false,
+        });
+      }
+      if (data.type === "invalid_parameters") {
+        new PNotify({
+          title: "Invalid parameters for <code>@" + data.command + "</code>",
+          text:
+            "These parameter declarations were dropped: <br>" +
+            data.errors.map((error) => _.escape(error)).join("<br>"),
+          type: "warning",
+          hide: false,
+        });
+      }
       if (data.type === "rendering_error") {
         new PNotify({
           title: "Error rendering macro <code>@" + data.command + "</code>",
           text:
             "There was an error rendering the macro. Please check your macro content and try again. " +
+            (data.reason ? "<br>" + _.escape(data.reason) + "<br>" : "") +
             "For more details check the <code>octoprint.log</code>.",
           type: "error",
           hide: false,
@@ -0,0 +1,239 @@
+from bisect import bisect_left
+
+# Upper bounds of the render time histogram buckets, in seconds. Anything slower goes into a final overflow bucket
+RENDER_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+class MacroStats:
+    """
+    Counters for a single macro.
+
+    Macros are rendered from OctoPrint's comm thread, and these are plain attribute updates, so there is no locking.
+    At worst a reader sees a render that's been half recorded.
+    """
+
+    __slots__ = (
+        "invocations",
+        "compiles",
+        "compile_time",
+        "render_time",
+        "render_time_max",
+        "render_time_buckets",
+        "lines",
+        "lines_max",
+        "depth_max",
+        "cache_hits",
+        "cache_misses",
+        "result_cache_hits",
+        "result_cache_misses",
+        "errors",
+    )
+
+    def __init__(self):
+        self.invocations = 0
+        self.compiles = 0
+        self.compile_time = 0.0
+        self.render_time = 0.0
+        self.render_time_max = 0.0
+        self.render_time_buckets = [0] * (len(RENDER_TIME_BUCKETS) + 1)
+        self.lines = 0
+        self.lines_max = 0
+        self.depth_max = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.result_cache_hits = 0
+        self.result_cache_misses = 0
+        self.errors = 0
+
+    def as_dict(self):
+        return {
+            "invocations": self.invocations,
+            "compiles": self.compiles,
+            "compile_time": self.compile_time,
+            "render_time": self.render_time,
+            "render_time_avg": self.render_time / self.invocations
+            if self.invocations
+            else 0.0,
+            "render_time_max": self.render_time_max,
+            "render_time_buckets": list(
+                zip(RENDER_TIME_BUCKETS + (None,), self.render_time_buckets)
+            ),
+            "lines": self.lines,
+            "lines_max": self.lines_max,
+            "depth_max": self.depth_max,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hits / (self.cache_hits + self.cache_misses)
+            if self.cache_hits + self.cache_misses
+            else None,
+            "result_cache_hits": self.result_cache_hits,
+            "result_cache_misses": self.result_cache_misses,
+            "result_cache_hit_rate": self.result_cache_hits
+            / (self.result_cache_hits + self.result_cache_misses)
+            if self.result_cache_hits + self.result_cache_misses
+            else None,
+            "errors": self.errors,
+        }
+
+
+class RenderStats:
+    """
+    Per-macro render statistics, see MacroStats
+    """
+
+    def __init__(self):
+        self.macros = {}
+
+        # Lines seen by the gcode queuing hook, and how many of those were macros
+        self.queueing_calls = 0
+        self.macro_hits = 0
+
+    def get(self, command):
+        stats = self.macros.get(command)
+        if stats is None:
+            stats = self.macros[command] = MacroStats()
+        return stats
+
+    def record_compile(self, command, duration):
+        stats = self.get(command)
+        stats.compiles += 1
+        stats.compile_time += duration
+
+    def record_cache(self, command, hit):
+        stats = self.get(command)
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+    def record_result_cache(self, command, hit):
+        stats = self.get(command)
+        if hit:
+            stats.result_cache_hits += 1
+        else:
+            stats.result_cache_misses += 1
+
+    def record_error(self, command):
+        self.get(command).errors += 1
+
+    def record_render(self, command, duration, lines, depth):
+        stats = self.get(command)
+        stats.invocations += 1
+        stats.render_time += duration
+        if duration > stats.render_time_max:
+            stats.render_time_max = duration
+        stats.render_time_buckets[bisect_left(RENDER_TIME_BUCKETS, duration)] += 1
+        stats.lines = lines
+        if lines > stats.lines_max:
+            stats.lines_max = lines
+        if depth > stats.depth_max:
+            stats.depth_max = depth
+
+    def prune(self, commands):
+        """
+        Drop statistics for macros that no longer exist
+        :param commands: iterable of macro commands to keep
+        """
+        keep = set(commands)
+        for command in list(self.macros.keys()):
+            if command not in keep:
+                del self.macros[command]
+
+    def as_dict(self):
+        return {command: stats.as_dict() for command, stats in self.macros.items()}
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_metrics(stats, render_counts, cache_sizes):
+    """
+    Format render statistics in the Prometheus text exposition format
+    :param stats: RenderStats
+    :param render_counts: dict, number of renders per path (static, templated)
+    :param cache_sizes: dict, number of entries per cache
+    :return: string
+    """
+    lines = [
+        "# HELP gcode_macro_queueing_calls_total Lines seen by the gcode queuing hook.",
+        "# TYPE gcode_macro_queueing_calls_total counter",
+        f"gcode_macro_queueing_calls_total {stats.queueing_calls}",
+        "# HELP gcode_macro_hits_total Queued lines that were macros.",
+        "# TYPE gcode_macro_hits_total counter",
+        f"gcode_macro_hits_total {stats.macro_hits}",
+        "# HELP gcode_macro_misses_total Queued lines that were not macros.",
+        "# TYPE gcode_macro_misses_total counter",
+        f"gcode_macro_misses_total {stats.queueing_calls - stats.macro_hits}",
+        "# HELP gcode_macro_path_renders_total Macro renders by path taken.",
+        "# TYPE gcode_macro_path_renders_total counter",
+    ]
+    for path, count in render_counts.items():
+        lines.append(f'gcode_macro_path_renders_total{{path="{path}"}} {count}')
+
+    lines += [
+        "# HELP gcode_macro_cache_entries Number of entries in each cache.",
+        "# TYPE gcode_macro_cache_entries gauge",
+    ]
+    for cache, size in cache_sizes.items():
+        lines.append(f'gcode_macro_cache_entries{{cache="{cache}"}} {size}')
+
+    counters = (
+        (
+            "invocations",
+            "gcode_macro_invocations_total",
+            "Macros rendered from an @ command.",
+        ),
+        ("errors", "gcode_macro_render_errors_total", "Errors while rendering macros."),
+        ("compiles", "gcode_macro_compiles_total", "Macro templates compiled."),
+        (
+            "compile_time",
+            "gcode_macro_compile_seconds_total",
+            "Time spent compiling macro templates.",
+        ),
+        (
+            "cache_hits",
+            "gcode_macro_cache_hits_total",
+            "Macro renders that used a cached template or expansion.",
+        ),
+        (
+            "cache_misses",
+            "gcode_macro_cache_misses_total",
+            "Macro renders that had to compile their template.",
+        ),
+        (
+            "result_cache_hits",
+            "gcode_macro_result_cache_hits_total",
+            "Templated macro renders served from the result cache.",
+        ),
+        (
+            "result_cache_misses",
+            "gcode_macro_result_cache_misses_total",
+            "Templated macro renders that missed the result cache.",
+        ),
+    )
+    for attribute, name, description in counters:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+        for command, macro in stats.macros.items():
+            lines.append(
+                f'{name}{{macro="{_escape_label(command)}"}} {getattr(macro, attribute)}'
+            )
+
+    name = "gcode_macro_render_duration_seconds"
+    lines += [
+        f"# HELP {name} Time taken to render macros, including sub-macros.",
+        f"# TYPE {name} histogram",
+    ]
+    for command, macro in stats.macros.items():
+        label = _escape_label(command)
+        cumulative = 0
+        for bound, count in zip(RENDER_TIME_BUCKETS, macro.render_time_buckets):
+            cumulative += count
+            lines.append(f'{name}_bucket{{macro="{label}",le="{bound}"}} {cumulative}')
+        lines += [
+            f'{name}_bucket{{macro="{label}",le="+Inf"}} {macro.invocations}',
+            f'{name}_sum{{macro="{label}"}} {macro.render_time}',
+            f'{name}_count{{macro="{label}"}} {macro.invocations}',
+        ]
+
+    return "\n".join(lines) + "\n"
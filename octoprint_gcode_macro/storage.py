@@ -0,0 +1,453 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from octoprint_gcode_macro.files import (
+    fsync_directory,
+    remove_stale_temp_files,
+    write_files,
+)
+from octoprint_gcode_macro.index import INDEX_FIELDS, index_entry
+
+# Index of the macro files, so they don't have to be read at startup, stored alongside them
+MACRO_INDEX_FILE = "index.json"
+
+# Bumped when the database layout changes, stored as the database's user_version
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS macros (
+    command TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    refs TEXT NOT NULL,
+    static INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    analysis TEXT
+);
+"""
+
+# Changes to the layout of an existing database, by the schema version they upgrade it to
+SCHEMA_UPGRADES = {
+    2: "ALTER TABLE macros ADD COLUMN analysis TEXT",
+}
+
+
+class StorageError(Exception):
+    pass
+
+
+def is_complete(entry):
+    """
+    :param entry: dict, stored index entry, or None
+    :return: bool, whether the entry has every field of INDEX_FIELDS
+    """
+    return entry is not None and all(field in entry for field in INDEX_FIELDS)
+
+
+class FileStorage:
+    """
+    Macros stored as files in one folder, named after their command with the extension .gcode, with an index of
+    them in index.json so they don't all have to be read at startup.
+    """
+
+    name = "files"
+
+    def __init__(self, folder, logger=None):
+        self.folder = folder
+        self._logger = logger or logging.getLogger(__name__)
+
+    def get_path(self, command):
+        return os.path.join(self.folder, f"{command}.gcode")
+
+    def load(self, commands, check=True):
+        """
+        Get the index entries of stored macros
+        :param commands: collection of commands that have a settings entry, other macros are ignored
+        :param check: bool, check every macro against its index entry now, otherwise macros missing from the index
+            get an entry with no hash, to be checked later
+        :return: dict, command -> index entry
+        """
+        # Left behind if OctoPrint stopped while saving, the macros themselves are intact
+        remove_stale_temp_files(self.folder)
+
+        index = self.read_index()
+        entries = {}
+        for file in Path(self.folder).glob("*.gcode"):
+            command = os.path.splitext(file.name)[0]
+            if command not in commands:
+                # Ignore if no settings entry for this file
+                # So we don't try and pick up random files I hope
+                continue
+
+            if check:
+                try:
+                    entries[command], _ = self.check(command, index.get(command))
+                except StorageError as e:
+                    self._logger.error(e)
+            elif is_complete(index.get(command)):
+                entries[command] = index[command]
+            else:
+                entries[command] = {**index_entry("", 0, None), "hash": None}
+
+        if check and entries != index:
+            self.save_index(entries)
+        return entries
+
+    def check(self, command, entry):
+        """
+        Get a macro's index entry, only reading it if it has changed since it was indexed
+        :param command: string, macro to check
+        :param entry: dict, previous index entry, None if it was not indexed
+        :return: tuple of (dict, index entry; string, content if it had to be read, or None)
+        """
+        path = self.get_path(command)
+        try:
+            stat = os.stat(path)
+            # Entries indexed by an older version are missing fields, and need working out again
+            if (
+                is_complete(entry)
+                and entry.get("size") == stat.st_size
+                and entry.get("mtime") == stat.st_mtime_ns
+            ):
+                return entry, None
+
+            with open(path, encoding="utf-8") as f:
+                content = f.read()
+        except OSError as e:
+            raise StorageError(f"Could not read macro {command}: {e}") from e
+        return index_entry(content, stat.st_size, stat.st_mtime_ns), content
+
+    def read(self, command):
+        try:
+            with open(self.get_path(command), encoding="utf-8") as f:
+                return f.read()
+        except OSError as e:
+            raise StorageError(f"Could not read macro {command}: {e}") from e
+
+    def write(self, contents, entries, removed):
+        """
+        Store new & changed macros and remove deleted ones. Each file is replaced atomically, with one sync for the
+        whole batch.
+        :param contents: dict, command -> content of macros to write
+        :param entries: dict, command -> index entry of macros to write, without size & mtime
+        :param removed: iterable of commands to remove
+        :return: tuple of (int, bytes written; dict, command -> {"size", "mtime"} as stored)
+        """
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+
+            # Remove files first, so a macro renamed to differ only in case isn't deleted on case-insensitive
+            # filesystems
+            removed_any = False
+            for command in removed:
+                try:
+                    os.remove(self.get_path(command))
+                    removed_any = True
+                except FileNotFoundError:
+                    pass
+
+            if not contents:
+                if removed_any:
+                    fsync_directory(self.folder)
+                return 0, {}
+
+            written = write_files(
+                self.folder,
+                {f"{command}.gcode": content for command, content in contents.items()},
+            )
+            stored = {}
+            for command in contents:
+                stat = os.stat(self.get_path(command))
+                stored[command] = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        except OSError as e:
+            raise StorageError(f"Could not write macro files: {e}") from e
+        return written, stored
+
+    def read_index(self):
+        try:
+            with open(
+                os.path.join(self.folder, MACRO_INDEX_FILE), encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            # Can be rebuilt from the files
+            self._logger.warning(f"Could not read the macro index, rebuilding it: {e}")
+            return {}
+
+    def save_index(self, entries):
+        """
+        Save the index entries of all macros
+        :param entries: dict, command -> index entry
+        """
+        index = {
+            command: {field: entry[field] for field in INDEX_FIELDS}
+            for command, entry in entries.items()
+        }
+        try:
+            # The index is rebuilt from the files if it's lost, no need to wait for it to be synced
+            os.makedirs(self.folder, exist_ok=True)
+            write_files(self.folder, {MACRO_INDEX_FILE: json.dumps(index)}, sync=False)
+        except OSError:
+            self._logger.exception("Could not write the macro index")
+
+    def close(self):
+        pass
+
+
+class SqliteStorage:
+    """
+    Macros stored in an SQLite database, one row per macro holding its content & index entry, keyed by command.
+    Saving is a single transaction however many macros changed, and nothing has to be checked against the content
+    at startup since the two are always written together. The first time it's opened, macros are imported from
+    the files of FileStorage in the same transaction that creates the database, the files are left as they are.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path, migrate_from=None, logger=None):
+        """
+        :param path: string, database file
+        :param migrate_from: string, folder of macro files to import when the database is created, or None
+        :param logger: logger, for the number of macros imported
+        """
+        self.path = path
+        self._migrate_from = migrate_from
+        self._logger = logger or logging.getLogger(__name__)
+        # Rows are read from the background loader's threads as well, one at a time
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+
+        try:
+            # Transactions are started explicitly, so several statements can share one
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Synced on every commit, like the macro files
+            connection.execute("PRAGMA synchronous=FULL")
+
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            imported = 0
+            if version < SCHEMA_VERSION:
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    if version == 0:
+                        connection.execute(SCHEMA)
+                        imported = self._migrate(connection)
+                    else:
+                        self._upgrade(connection, version)
+                    connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+                if imported:
+                    self._logger.info(
+                        f"Imported {imported} macros from {self._migrate_from} into {self.path}"
+                    )
+        except (sqlite3.Error, OSError) as e:
+            raise StorageError(
+                f"Could not open the macro database {self.path}: {e}"
+            ) from e
+
+        self._connection = connection
+        return connection
+
+    @staticmethod
+    def _upgrade(connection, version):
+        for upgrade in range(version + 1, SCHEMA_VERSION + 1):
+            connection.execute(SCHEMA_UPGRADES[upgrade])
+
+        # Index entries are worked out again from the content, in case what they hold changed too
+        rows = connection.execute("SELECT command, content FROM macros").fetchall()
+        for command, content in rows:
+            entry = index_entry(content, 0, None)
+            connection.execute(
+                "UPDATE macros SET hash = ?, refs = ?, static = ?, analysis = ? WHERE command = ?",
+                (
+                    entry["hash"],
+                    json.dumps(entry["references"]),
+                    entry["static"],
+                    json.dumps(entry["analysis"]),
+                    command,
+                ),
+            )
+
+    def _migrate(self, connection):
+        if self._migrate_from is None or not os.path.isdir(self._migrate_from):
+            return 0
+
+        files = FileStorage(self._migrate_from, self._logger)
+        imported = 0
+        for file in Path(self._migrate_from).glob("*.gcode"):
+            command = os.path.splitext(file.name)[0]
+            # Raises for a file that can't be read, rather than leaving it behind
+            content = files.read(command)
+            self._insert(
+                connection,
+                command,
+                content,
+                index_entry(content, 0, None),
+                time.time_ns(),
+            )
+            imported += 1
+        return imported
+
+    @staticmethod
+    def _insert(connection, command, content, entry, mtime):
+        size = len(content.encode("utf-8"))
+        values = (
+            content,
+            size,
+            mtime,
+            entry["hash"],
+            json.dumps(entry["references"]),
+            entry["static"],
+            json.dumps(entry["analysis"]),
+            command,
+        )
+        # Not an upsert, which needs SQLite 3.24 & Python 3.7 may come with an older one
+        updated = connection.execute(
+            "UPDATE macros SET content = ?, size = ?, mtime = ?, hash = ?, refs = ?, static = ?, "
+            "analysis = ?, version = version + 1 WHERE command = ?",
+            values,
+        ).rowcount
+        if not updated:
+            connection.execute(
+                "INSERT INTO macros (content, size, mtime, hash, refs, static, analysis, command) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                values,
+            )
+        return size
+
+    def load(self, commands, check=True):
+        """
+        Get the index entries of stored macros, without reading their content. Content & index are written in the
+        same transaction, so there is never anything to check.
+        :param commands: collection of commands that have a settings entry, other macros are ignored
+        :param check: bool, unused
+        :return: dict, command -> index entry
+        """
+        with self._lock:
+            try:
+                rows = (
+                    self._connect()
+                    .execute(
+                        "SELECT command, size, mtime, hash, refs, static, analysis FROM macros"
+                    )
+                    .fetchall()
+                )
+            except sqlite3.Error as e:
+                raise StorageError(
+                    f"Could not load macros from {self.path}: {e}"
+                ) from e
+
+        return {
+            command: {
+                "size": size,
+                "mtime": mtime,
+                "hash": digest,
+                "references": json.loads(refs),
+                "static": bool(static),
+                "analysis": json.loads(analysis),
+            }
+            for command, size, mtime, digest, refs, static, analysis in rows
+            if command in commands
+        }
+
+    def check(self, command, entry):
+        return entry, None
+
+    def read(self, command):
+        with self._lock:
+            try:
+                row = (
+                    self._connect()
+                    .execute("SELECT content FROM macros WHERE command = ?", (command,))
+                    .fetchone()
+                )
+            except sqlite3.Error as e:
+                raise StorageError(f"Could not read macro {command}: {e}") from e
+        if row is None:
+            raise StorageError(f"Macro {command} is not in {self.path}")
+        return row[0]
+
+    def write(self, contents, entries, removed):
+        """
+        Store new & changed macros and remove deleted ones, all in one transaction
+        :param contents: dict, command -> content of macros to write
+        :param entries: dict, command -> index entry of macros to write, without size & mtime
+        :param removed: iterable of commands to remove
+        :return: tuple of (int, bytes written; dict, command -> {"size", "mtime"} as stored)
+        """
+        mtime = time.time_ns()
+        written = 0
+        stored = {}
+        with self._lock:
+            try:
+                connection = self._connect()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    connection.executemany(
+                        "DELETE FROM macros WHERE command = ?",
+                        [(command,) for command in removed],
+                    )
+                    for command, content in contents.items():
+                        size = self._insert(
+                            connection, command, content, entries[command], mtime
+                        )
+                        stored[command] = {"size": size, "mtime": mtime}
+                        written += size
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                raise StorageError(f"Could not save macros to {self.path}: {e}") from e
+        return written, stored
+
+    def save_index(self, entries):
+        # The index is stored with the content
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# Names of the storage backends, as used in the settings
+STORAGE_BACKENDS = (FileStorage.name, SqliteStorage.name)
+
+
+def create_storage(backend, data_folder, logger=None):
+    """
+    Create the storage backend for macros
+    :param backend: string, name of the backend, see STORAGE_BACKENDS
+    :param data_folder: string, plugin data folder
+    :param logger: logger
+    :return: FileStorage or SqliteStorage
+    :raises ValueError: if there is no backend with that name
+    """
+    macro_folder = os.path.join(data_folder, "macros")
+    if backend == FileStorage.name:
+        return FileStorage(macro_folder, logger)
+    if backend == SqliteStorage.name:
+        return SqliteStorage(
+            os.path.join(data_folder, "macros.db"), macro_folder, logger
+        )
+    raise ValueError(f"Unknown macro storage backend {backend}")
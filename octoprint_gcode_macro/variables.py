@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import threading
+import types
+
+from octoprint_gcode_macro.files import fsync_directory
+
+# Seconds to wait after a variable is saved for more to write in the same batch
+FLUSH_DELAY = 0.5
+
+# The log is compacted once it has this many lines more than there are variables
+COMPACT_THRESHOLD = 1000
+
+
+class VariableStore:
+    """
+    Variables saved by macros, kept in memory & persisted to an append-only log of JSON lines in the background.
+    Saving a variable never waits on the disk: the line is queued for a writer thread, which appends a batch of them
+    with one fsync. The log is rewritten with only the latest values once it has grown enough.
+    """
+
+    def __init__(self, path, logger=None, name="gcode_macro.variables"):
+        self._path = path
+        self._logger = logger or logging.getLogger(__name__)
+        self._name = name
+
+        self._values = {}
+        # Read-only view for templates, so they can only change variables through save_variable
+        self.values = types.MappingProxyType(self._values)
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._log_lines = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._load()
+
+    def _load(self):
+        corrupt = 0
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._values[entry["name"]] = entry["value"]
+                    except (ValueError, KeyError, TypeError):
+                        # Most likely the last line, cut short by a power cut
+                        corrupt += 1
+                    self._log_lines += 1
+        except FileNotFoundError:
+            return
+
+        if corrupt:
+            self._logger.warning(
+                f"Skipped {corrupt} unreadable lines in {self._path}, rewriting it"
+            )
+            self._compact()
+
+    def get(self, name, default=None):
+        return self._values.get(name, default)
+
+    def save(self, name, value):
+        """
+        Save a variable, available to templates as save_variable(name, value)
+        :param name: string, variable name
+        :param value: anything JSON can store
+        :return: empty string, so nothing is output when it's called in {{ }}
+        """
+        line = json.dumps({"name": str(name), "value": value}) + "\n"
+        with self._lock:
+            self._values[str(name)] = value
+            self._pending.append(line)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name=self._name, daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+        return ""
+
+    def _work(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            # Give other saves from the same macro a chance to join the batch
+            self._stop.wait(FLUSH_DELAY)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write the saved variables that are waiting, then compact the log if it's grown enough
+        """
+        with self._lock:
+            lines, self._pending = self._pending, []
+        if not lines:
+            return
+
+        try:
+            with open(self._path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            self._logger.exception(f"Could not save variables to {self._path}")
+            with self._lock:
+                self._pending = lines + self._pending
+            return
+
+        self._log_lines += len(lines)
+        if self._log_lines > len(self._values) + COMPACT_THRESHOLD:
+            self._compact()
+
+    def _compact(self):
+        with self._lock:
+            lines = [
+                json.dumps({"name": name, "value": value}) + "\n"
+                for name, value in self._values.items()
+            ]
+            # Anything pending is in the values already
+            self._pending = []
+
+        temp_path = self._path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._path)
+            fsync_directory(os.path.dirname(self._path))
+        except OSError:
+            self._logger.exception(f"Could not compact {self._path}")
+            return
+
+        self._log_lines = len(lines)
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(FLUSH_DELAY * 4)
+        self.flush()
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+
+from octoprint_gcode_macro.files import TEMP_SUFFIX
+
+try:
+    # Comes with OctoPrint, uses inotify on Linux
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# Seconds without any more changes before a batch of changed files is reported, so copying a lot of files is one batch
+DEBOUNCE_DELAY = 0.5
+
+# Seconds between scans of the folder when polling
+POLL_INTERVAL = 2.0
+
+# Changes to anything else, such as files being read, don't need reloading
+WATCHED_EVENTS = frozenset(["created", "modified", "moved", "deleted"])
+
+
+class FileWatcher:
+    """
+    Watches a folder & everything in it for changed files, reporting them in batches once the changes stop. Uses
+    watchdog's observer if it can, otherwise the folder is polled, which only reports a batch once a scan finds
+    nothing more has changed.
+    Hidden files & files being written (see TEMP_SUFFIX) are not reported, they are renamed into place when done.
+    """
+
+    def __init__(
+        self,
+        folder,
+        on_change,
+        ignore=(),
+        polling=False,
+        logger=None,
+        name="gcode_macro.watcher",
+    ):
+        """
+        :param folder: string, folder to watch
+        :param on_change: callable, called from a background thread with a set of changed paths, relative to the folder
+            & separated by /
+        :param ignore: tuple of path prefixes, relative to the folder, not to report
+        :param polling: bool, poll even if watchdog is available
+        :param logger: logger
+        :param name: string, name of the background thread
+        """
+        self.folder = folder
+        self._on_change = on_change
+        self._ignore = tuple(ignore)
+        self._logger = logger or logging.getLogger(__name__)
+        self._name = name
+
+        self.polling = polling or Observer is None
+        self._observer = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def start(self):
+        if not self.polling:
+            try:
+                observer = Observer()
+                observer.schedule(self, self.folder, recursive=True)
+                observer.daemon = True
+                observer.start()
+                self._observer = observer
+            except Exception as e:
+                # Most likely out of inotify watches
+                self._logger.warning(
+                    f"Could not watch {self.folder} for changes, polling instead: {e}"
+                )
+                self.polling = True
+
+        self._thread = threading.Thread(
+            target=self._poll if self.polling else self._work,
+            name=self._name,
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join(DEBOUNCE_DELAY * 4)
+            self._thread = None
+
+    def is_ignored(self, path):
+        """
+        :param path: string, relative to the folder & separated by /
+        :return: bool, whether changes to the path are not reported
+        """
+        name = path.rsplit("/", 1)[-1]
+        return (
+            name.startswith(".")
+            or name.endswith(TEMP_SUFFIX)
+            or path.startswith(self._ignore)
+        )
+
+    # Called by watchdog's observer
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in WATCHED_EVENTS:
+            return
+
+        paths = set()
+        for path in (event.src_path, getattr(event, "dest_path", None)):
+            if path:
+                path = os.path.relpath(os.fsdecode(path), self.folder)
+                path = path.replace(os.sep, "/")
+                if not self.is_ignored(path):
+                    paths.add(path)
+
+        if paths:
+            with self._lock:
+                self._pending.update(paths)
+            self._wake.set()
+
+    def _work(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            # Wait for the changes to stop, until nothing more has changed for the delay
+            while self._wake.is_set():
+                self._wake.clear()
+                if self._stop.wait(DEBOUNCE_DELAY):
+                    return
+            self._report()
+
+    def _poll(self):
+        snapshot = self.scan()
+        while not self._stop.wait(POLL_INTERVAL):
+            current = self.scan()
+            changed = {
+                path
+                for path in snapshot.keys() | current.keys()
+                if snapshot.get(path) != current.get(path)
+            }
+            snapshot = current
+            if changed:
+                with self._lock:
+                    self._pending.update(changed)
+            else:
+                self._report()
+
+    def scan(self):
+        """
+        :return: dict, path -> (size, modification time) of every file that is not ignored
+        """
+        files = {}
+        folders = [""]
+        while folders:
+            folder = folders.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self.folder, folder)))
+            except OSError:
+                # Removed while scanning
+                continue
+            for entry in entries:
+                path = folder + entry.name
+                try:
+                    if entry.is_dir():
+                        if not self.is_ignored(path + "/"):
+                            folders.append(path + "/")
+                    elif not self.is_ignored(path):
+                        stat = entry.stat()
+                        files[path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue
+        return files
+
+    def _report(self):
+        with self._lock:
+            paths, self._pending = self._pending, set()
+        if not paths:
+            return
+        try:
+            self._on_change(paths)
+        except Exception:
+            self._logger.exception(f"Could not reload changed files: {sorted(paths)}")
@@ -0,0 +1,80 @@
+import queue
+import threading
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+class RenderWorker:
+    """
+    Renders templates on a separate daemon thread, so OctoPrint's comm thread can give up on a template that takes
+    too long. Python threads can't be killed, so a worker stuck on a template is abandoned to finish in its own time
+    and a fresh one takes over for the next render.
+    """
+
+    def __init__(self, name="gcode_macro.render"):
+        self._name = name
+        self._lock = threading.Lock()
+        self._jobs = None
+
+    def _get_jobs(self):
+        with self._lock:
+            if self._jobs is None:
+                self._jobs = queue.Queue()
+                thread = threading.Thread(
+                    target=self._work, args=(self._jobs,), name=self._name, daemon=True
+                )
+                thread.start()
+            return self._jobs
+
+    @staticmethod
+    def _work(jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+
+            try:
+                job["result"] = job["function"](*job["args"])
+            except Exception as e:
+                job["error"] = e
+            finally:
+                job["done"].set()
+
+    def run(self, timeout, function, *args):
+        """
+        Run a function on the worker thread, waiting for it to finish
+        :param timeout: float, seconds to wait for the result
+        :param function: callable to run
+        :param args: arguments to pass to the callable
+        :return: the function's return value
+        :raises RenderTimeout: if the function did not finish in time
+        """
+        jobs = self._get_jobs()
+        job = {
+            "function": function,
+            "args": args,
+            "done": threading.Event(),
+            "result": None,
+            "error": None,
+        }
+        jobs.put(job)
+
+        if not job["done"].wait(timeout):
+            with self._lock:
+                if self._jobs is jobs:
+                    self._jobs = None
+            # Tell the stuck thread to exit once it's done, the next render starts a new one
+            jobs.put(None)
+            raise RenderTimeout(f"Rendering did not finish within {timeout}s")
+
+        if job["error"] is not None:
+            raise job["error"]
+        return job["result"]
+
+    def shutdown(self):
+        with self._lock:
+            if self._jobs is not None:
+                self._jobs.put(None)
+                self._jobs = None
@@ -0,0 +1,39 @@
+import pytest
+
+from benchmarks.harness import create_plugin
+
+
+@pytest.fixture
+def make_plugin(tmp_path):
+    """
+    Create the plugin the way OctoPrint would, with a data folder of its own. Keyword arguments override the
+    default settings, all plugins created are shut down after the test.
+    """
+    plugins = []
+
+    def make(data_folder=None, **settings):
+        plugin = create_plugin(str(data_folder or tmp_path / "data"), **settings)
+        plugins.append(plugin)
+        return plugin
+
+    yield make
+
+    for plugin in plugins:
+        plugin.on_shutdown()
+
+
+@pytest.fixture
+def save_macros():
+    """
+    Save macros to a plugin the way the settings dialog does, takes the plugin & a dict of command -> content
+    """
+
+    def save(plugin, macros):
+        plugin.save_macros(
+            [
+                {"command": command, "content": content, "description": ""}
+                for command, content in macros.items()
+            ]
+        )
+
+    return save
@@ -0,0 +1,108 @@
+import os
+import threading
+
+from octoprint_gcode_macro.storage import MACRO_INDEX_FILE, FileStorage
+
+MACROS = {
+    "home": "G28\n@level\n",
+    "level": "G29\n@park\n",
+    "park": "G1 Z10\nG1 X0 Y0\n",
+    "heat": "M104 S{{ params.T|default(200) }}\n@park\n",
+}
+
+
+def counted_bytes(plugin):
+    return sum(
+        compiled["size"] + compiled["flattened_size"]
+        for compiled in plugin._compiled.values()
+    )
+
+
+def test_flattened_macros_are_released(make_plugin, save_macros):
+    plugin = make_plugin(preload_threads=0)
+    save_macros(plugin, MACROS)
+
+    expanded = ["G28", "G29", "G1 Z10", "G1 X0 Y0"]
+    assert plugin.render_macro("@home") == expanded
+    assert plugin._compiled["home"]["flattened_size"] == len("\n".join(expanded)) + 1
+    assert plugin._compiled_bytes == counted_bytes(plugin)
+
+    # Worked out again after every change to the call graph, without counting the old trees
+    for _ in range(3):
+        plugin.build_call_graph()
+        assert plugin._compiled_bytes == counted_bytes(plugin)
+        assert plugin._compiled_bytes == sum(
+            compiled["size"] for compiled in plugin._compiled.values()
+        )
+        assert plugin.render_macro("@home") == expanded
+        assert plugin._compiled_bytes == counted_bytes(plugin)
+
+    plugin.drop_compiled("home")
+    assert plugin._compiled_bytes == counted_bytes(plugin)
+
+
+def test_macros_are_read_once_when_compiled(make_plugin, monkeypatch, save_macros):
+    plugin = make_plugin(preload_threads=0)
+    save_macros(plugin, MACROS)
+
+    reads = []
+    read = plugin.storage.read
+
+    def count(command):
+        reads.append(command)
+        return read(command)
+
+    monkeypatch.setattr(plugin.storage, "read", count)
+    assert plugin.render_macro("@heat T=210") == ["M104 S210", "G1 Z10", "G1 X0 Y0"]
+    assert reads.count("heat") == 1
+
+
+def test_unchecked_circular_macros_expand_at_runtime(
+    make_plugin, monkeypatch, save_macros
+):
+    plugin = make_plugin(preload_threads=0)
+    save_macros(plugin, {"slow": "G4\n", "a": "G1\n@b\n", "b": "G2\n@a\n"})
+    os.remove(os.path.join(plugin.storage.folder, MACRO_INDEX_FILE))
+
+    # Without an index both look static & acyclic until they've been checked, keep the loader busy meanwhile
+    blocked = threading.Event()
+    check = FileStorage.check
+
+    def slow_check(self, command, entry):
+        if command == "slow":
+            blocked.wait(10)
+        return check(self, command, entry)
+
+    monkeypatch.setattr(FileStorage, "check", slow_check)
+    restarted = make_plugin(preload_threads=1, macros=plugin._settings.get(["macros"]))
+
+    result = []
+    render = threading.Thread(
+        target=lambda: result.append(restarted.render_macro("@a"))
+    )
+    render.start()
+    render.join(5)
+    blocked.set()
+    assert not render.is_alive()
+    assert result[0][:4] == ["G1", "G2", "G1", "G2"]
+
+
+def test_circular_macros_are_not_flattened(make_plugin, save_macros):
+    plugin = make_plugin(preload_threads=0)
+    save_macros(plugin, {"a": "G1\n@b\n", "b": "G2\n@a\n"})
+
+    # Even if the call graph thought they weren't
+    plugin.macros["a"]["static"] = plugin.macros["b"]["static"] = True
+    assert plugin.flatten_macro("a") is None
+    assert "a" not in plugin._flattened
+
+
+def test_evicted_macros_are_released_by_jinja(make_plugin, save_macros):
+    plugin = make_plugin(preload_threads=0, macro_memory_kb=1)
+    save_macros(plugin, {f"m{i}": f"G4 P{{{{ {i} }}}}\n" * 20 for i in range(50)})
+
+    for i in range(50):
+        assert plugin.render_macro(f"@m{i}") == [f"G4 P{i}"] * 20
+    cached = {key[1] for key in plugin.jinja_env.cache.keys()}
+    assert len(plugin._compiled) < 50
+    assert cached == {"@" + command for command in plugin._compiled}
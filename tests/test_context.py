@@ -0,0 +1,22 @@
+import os
+
+
+def test_included_templates_get_the_printer_state(make_plugin, save_macros):
+    plugin = make_plugin(preload_threads=0)
+    with open(
+        os.path.join(plugin.get_plugin_data_folder(), "position.jinja2"), "w"
+    ) as f:
+        f.write("G1 Z{{ printer.position.z }}\n")
+    save_macros(
+        plugin,
+        {
+            "park": "G1 X{{ printer.position.x }}\n",
+            "from_file": "{% include 'position.jinja2' %}",
+            "from_macro": "G28\n{% include '@park' %}",
+        },
+    )
+    plugin.printer_state.on_position_update({"x": 10, "z": 5})
+
+    # Neither macro mentions printer itself
+    assert plugin.render_macro("@from_file") == ["G1 Z5"]
+    assert plugin.render_macro("@from_macro") == ["G28", "G1 X10"]
@@ -0,0 +1,176 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from octoprint_gcode_macro import files
+from octoprint_gcode_macro.files import TEMP_SUFFIX, write_files
+from octoprint_gcode_macro.storage import FileStorage
+
+OLD = {f"m{i}": f"G1 X{i} ; old\nM117 60°C\n" * 50 for i in range(5)}
+NEW = {command: content.replace("old", "new") for command, content in OLD.items()}
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def gcode_files(contents):
+    return {f"{command}.gcode": content for command, content in contents.items()}
+
+
+def assert_old_or_new(folder):
+    storage = FileStorage(str(folder))
+    entries = storage.load(OLD.keys())
+    assert sorted(entries) == sorted(OLD)
+    for command in OLD:
+        assert storage.read(command) in (OLD[command], NEW[command])
+    assert not [name for name in os.listdir(folder) if name.endswith(TEMP_SUFFIX)]
+
+
+@pytest.mark.parametrize("call", range(len(OLD)))
+@pytest.mark.parametrize("step", ["sync", "replace"])
+def test_interrupted_write_leaves_old_or_new_content(tmp_path, monkeypatch, step, call):
+    write_files(str(tmp_path), gcode_files(OLD))
+
+    real = files.fdatasync if step == "sync" else os.replace
+    calls = []
+
+    def interrupt(*args):
+        if len(calls) == call:
+            raise Interrupted()
+        calls.append(args)
+        return real(*args)
+
+    if step == "sync":
+        monkeypatch.setattr(files, "fdatasync", interrupt)
+    else:
+        monkeypatch.setattr(os, "replace", interrupt)
+
+    with pytest.raises(Interrupted):
+        write_files(str(tmp_path), gcode_files(NEW))
+    monkeypatch.undo()
+
+    assert_old_or_new(tmp_path)
+
+
+CRASH = """
+import json, os, sys
+from octoprint_gcode_macro.files import write_files
+
+folder, crash_at, contents = sys.argv[1], int(sys.argv[2]), json.loads(sys.argv[3])
+replace = os.replace
+calls = []
+
+def crash(*args):
+    if len(calls) == crash_at:
+        # Nothing gets to clean up, like a power cut
+        os._exit(3)
+    calls.append(args)
+    replace(*args)
+
+os.replace = crash
+write_files(folder, contents)
+"""
+
+
+@pytest.mark.parametrize("crash_at", range(len(OLD)))
+def test_crashed_write_leaves_old_or_new_content(tmp_path, crash_at):
+    write_files(str(tmp_path), gcode_files(OLD))
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            CRASH,
+            str(tmp_path),
+            str(crash_at),
+            json.dumps(gcode_files(NEW)),
+        ],
+        env={**os.environ, "PYTHONPATH": str(Path(__file__).parents[1])},
+    )
+    assert result.returncode == 3
+    # Temporary files are left behind, loading removes them
+    assert any(name.endswith(TEMP_SUFFIX) for name in os.listdir(tmp_path))
+
+    assert_old_or_new(tmp_path)
+
+
+def test_interrupted_save_keeps_macros(make_plugin, monkeypatch):
+    plugin = make_plugin(preload_threads=0)
+    plugin.save_macros(
+        [
+            {"command": command, "content": content, "description": ""}
+            for command, content in OLD.items()
+        ]
+    )
+
+    calls = []
+
+    def fail(*args):
+        if len(calls) == 2:
+            raise OSError("No space left on device")
+        calls.append(args)
+        return files.os.fsync(*args)
+
+    monkeypatch.setattr(files, "fdatasync", fail)
+    plugin.save_macros(
+        [
+            {"command": command, "content": content, "description": ""}
+            for command, content in NEW.items()
+        ]
+    )
+    monkeypatch.undo()
+
+    macros = {
+        macro["command"]: macro["content"]
+        for macro in plugin.on_settings_load()["macros"]
+    }
+    assert macros == OLD
+
+    # Saved properly next time
+    plugin.save_macros(
+        [
+            {"command": command, "content": content, "description": ""}
+            for command, content in NEW.items()
+        ]
+    )
+    macros = {
+        macro["command"]: macro["content"]
+        for macro in plugin.on_settings_load()["macros"]
+    }
+    assert macros == NEW
+
+
+READ = """
+import sys
+from octoprint_gcode_macro.index import content_hash
+from octoprint_gcode_macro.storage import FileStorage
+
+storage = FileStorage(sys.argv[1])
+entry, content = storage.check("hot", None)
+expected = "M117 60\\u00b0C"
+print(storage.read("hot") == content == expected, entry["hash"] == content_hash(expected))
+"""
+
+
+def test_macros_are_read_as_utf8_whatever_the_locale(tmp_path):
+    write_files(str(tmp_path), {"hot.gcode": "M117 60°C"})
+
+    result = subprocess.run(
+        [sys.executable, "-c", READ, str(tmp_path)],
+        env={
+            **os.environ,
+            "PYTHONPATH": str(Path(__file__).parents[1]),
+            "LC_ALL": "C",
+            "PYTHONUTF8": "0",
+            "PYTHONCOERCECLOCALE": "0",
+            "PYTHONIOENCODING": "utf-8",
+        },
+        capture_output=True,
+        text=True,
+    )
+    assert result.stdout.split() == ["True", "True"], result.stderr
@@ -0,0 +1,20 @@
+import pytest
+
+from octoprint_gcode_macro.gcode import split_commands
+
+
+@pytest.mark.parametrize(
+    "content, commands",
+    [
+        ("", ()),
+        ("G28\n\n  G1 Z10  \n", ("G28", "G1 Z10")),
+        ("G28 ; home\n; comment only\nM84", ("G28", "M84")),
+        ("G1 X10 (move) Y10\n(note)\nM117 done", ("G1 X10  Y10", "M117 done")),
+        ("(a;b) G4 P1\nG4 (c) ; d (e)", ("G4 P1", "G4")),
+        # Unclosed parentheses aren't a comment, and don't carry over to the next line
+        ("M117 (x\nG4 P2)", ("M117 (x", "G4 P2)")),
+        ("G28\r\nM84\r\n", ("G28", "M84")),
+    ],
+)
+def test_split_commands(content, commands):
+    assert split_commands(content) == commands
@@ -0,0 +1,36 @@
+def test_queuing_hook(make_plugin):
+    plugin = make_plugin(preload_threads=0)
+    plugin.save_macros(
+        [
+            {"command": "start", "content": "G28", "description": ""},
+            {
+                "command": "print start",
+                "content": "M190 S{{ params.BED|default(60) }}",
+                "description": "",
+            },
+            {"command": "pause", "content": "M25", "description": ""},
+        ]
+    )
+
+    def hook(line):
+        return plugin.gcode_queueing(
+            None, "queuing", line, None, None, subcode=None, tags=None
+        )
+
+    assert hook("@start") == ["G28"]
+    assert hook("@start X=1") == ["G28"]
+    assert hook("@print start") == ["M190 S60"]
+    assert hook("@print start BED=70") == ["M190 S70"]
+    assert hook("@print start A=1 B=2 BED=80 C=3 D=4") == ["M190 S80"]
+
+    # Left for OctoPrint & other plugins
+    for line in (
+        "G1 X10",
+        "@OCTOLAPSE TAKE-SNAPSHOT",
+        "@print",
+        "@pause",
+        "@pause X=1",
+    ):
+        assert hook(line) is None
+    assert plugin.stats.queueing_calls == 10
+    assert plugin.stats.macro_hits == 5
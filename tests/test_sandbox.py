@@ -0,0 +1,112 @@
+import tracemalloc
+
+import pytest
+
+from octoprint_gcode_macro.sandbox import BudgetedSandbox
+
+SANDBOX = {
+    "enabled": True,
+    "max_loop_iterations": 1000,
+    "max_output_bytes": 1000,
+    "max_output_lines": 100,
+}
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    plugin = make_plugin(preload_threads=0, sandbox=dict(SANDBOX))
+    assert isinstance(plugin.jinja_env, BudgetedSandbox)
+    return plugin
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        # Neither can loop, but a single expression can still produce any amount of output
+        '{{ "%*d" % (params.W|int, 1) }}',
+        '{{ "x"|center(params.W|int) }}',
+        '{{ "x"|indent(params.W|int, true) }}',
+        '{{ "%*d"|format(params.W|int, 1) }}',
+    ],
+)
+def test_output_limits_apply_to_templates_without_loops(plugin, content, save_macros):
+    save_macros(plugin, {"wide": content})
+    assert not plugin.compile_macro("wide")["budgeted"]
+
+    assert plugin.render_macro("@wide W=100") is not None
+    assert plugin.render_macro("@wide W=1000000") is None
+    message = plugin._plugin_manager.messages[-1]
+    assert message["type"] == "rendering_error"
+    assert "output limit" in message["reason"]
+
+
+def test_loop_budget(plugin, save_macros):
+    save_macros(plugin, {"loop": "{% for i in range(params.N|int) %}G4\n{% endfor %}"})
+    assert plugin.compile_macro("loop")["budgeted"]
+
+    assert plugin.render_macro("@loop N=10") == ["G4"] * 10
+    assert plugin.render_macro("@loop N=100000") is None
+    assert "loop iterations" in plugin._plugin_manager.messages[-1]["reason"]
+    # The budget is reset for every render
+    assert plugin.render_macro("@loop N=10") == ["G4"] * 10
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        '{{ "%*d" % (params.W|int, 1) }}',
+        '{{ "%.*f" % (params.W|int, 1) }}',
+        '{{ "%400000000d" % 1 }}',
+        '{{ "x"|center(params.W|int) }}',
+        '{{ "x"|indent(params.W|int, true) }}',
+        '{{ "x".rjust(params.W|int) }}',
+    ],
+)
+def test_widths_are_checked_before_padding(plugin, content, save_macros):
+    save_macros(plugin, {"wide": content})
+
+    tracemalloc.start()
+    try:
+        assert plugin.render_macro("@wide W=400000000") is None
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert "output limit" in plugin._plugin_manager.messages[-1]["reason"]
+    assert peak < 10_000_000
+
+
+def test_every_loop_iteration_is_counted(plugin, save_macros):
+    save_macros(
+        plugin,
+        {
+            "ranges": "{% set r = range(params.N|int) %}"
+            "{% for i in r %}{% for j in r %}{% for k in r %}{% endfor %}{% endfor %}{% endfor %}G4",
+            "lists": "{% set l = [0] * (params.N|int) %}"
+            "{% for i in l %}{% for j in l %}{% for k in l %}{% endfor %}{% endfor %}{% endfor %}G4",
+            "recursive": "{% set tree = [{'c': [{'c': [{'c': []}] * 30}] * 30}] * 30 %}"
+            "{% for node in tree recursive %}{{ loop(node.c) }}{% endfor %}",
+        },
+    )
+
+    # 39 iterations in 13 passes over the same 3 items
+    assert plugin.render_macro("@ranges N=3") == ["G4"]
+    assert plugin.render_macro("@lists N=3") == ["G4"]
+    assert plugin.render_macro("@ranges N=300") is None
+    assert "loop iterations" in plugin._plugin_manager.messages[-1]["reason"]
+    assert plugin.render_macro("@lists N=300") is None
+    assert "loop iterations" in plugin._plugin_manager.messages[-1]["reason"]
+    assert plugin.render_macro("@recursive") is None
+    assert "loop iterations" in plugin._plugin_manager.messages[-1]["reason"]
+
+
+def test_ranges_behave_like_ranges(plugin, save_macros):
+    save_macros(
+        plugin,
+        {
+            "ranges": "{{ range(5)|list }} {{ range(5)[1:3]|list }} {{ 3 in range(5) }} "
+            "{{ range(5)|length }} {{ range(5)|reverse|list }} {{ range(5)[-1] }}"
+        },
+    )
+    assert plugin.render_macro("@ranges") == [
+        "[0, 1, 2, 3, 4] [1, 2] True 5 [4, 3, 2, 1, 0] 4"
+    ]
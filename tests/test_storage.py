@@ -0,0 +1,126 @@
+import json
+import sqlite3
+
+import pytest
+from jinja2 import Environment
+
+from octoprint_gcode_macro.index import index_entry
+from octoprint_gcode_macro.storage import (
+    MACRO_INDEX_FILE,
+    FileStorage,
+    SqliteStorage,
+    create_storage,
+)
+
+MACROS = {
+    "static": "G28\nG1 Z10\n",
+    "heat": "M104 S{{ params.T|default(200) }}\n{% for i in range(3) %}G4 P{{ i }}\n{% endfor %}",
+    "park": "G1 X{{ printer.position.x }}\n@static\n",
+}
+
+
+@pytest.fixture
+def never_parse(monkeypatch):
+    def parse(*args, **kwargs):
+        raise AssertionError("Template was parsed")
+
+    def enable():
+        monkeypatch.setattr(Environment, "_parse", parse)
+
+    return enable
+
+
+@pytest.mark.parametrize("storage", ["files", "sqlite"])
+def test_indexed_macros_compile_without_parsing(
+    make_plugin, tmp_path, never_parse, storage, save_macros
+):
+    plugin = make_plugin(preload_threads=0, storage=storage)
+    save_macros(plugin, MACROS)
+    assert plugin.render_macro("@heat") == ["M104 S200", "G4 P0", "G4 P1", "G4 P2"]
+    plugin.compile_macro("park")
+
+    # Compiled from the bytecode cache after a restart, with the analysis from the index
+    restarted = make_plugin(
+        preload_threads=0, storage=storage, macros=plugin._settings.get(["macros"])
+    )
+    never_parse()
+    assert restarted.render_macro("@heat T=210") == [
+        "M104 S210",
+        "G4 P0",
+        "G4 P1",
+        "G4 P2",
+    ]
+    compiled = restarted.compile_macro("park")
+    assert compiled["printer_fields"] == frozenset(["position"])
+    assert compiled["variables"] == frozenset(["printer"])
+    assert restarted._compiled["heat"]["budgeted"]
+
+
+def test_index_without_analysis_is_rebuilt(tmp_path):
+    folder = tmp_path / "macros"
+    folder.mkdir()
+    storage = FileStorage(str(folder))
+    storage.write(MACROS, {}, [])
+    storage.load(MACROS)
+
+    # As written by an older version
+    index = json.loads((folder / MACRO_INDEX_FILE).read_text())
+    for entry in index.values():
+        del entry["analysis"]
+    (folder / MACRO_INDEX_FILE).write_text(json.dumps(index))
+
+    assert storage.load(MACROS, check=False)["heat"]["hash"] is None
+    entries = storage.load(MACROS)
+    assert (
+        entries["heat"]["analysis"] == index_entry(MACROS["heat"], 0, None)["analysis"]
+    )
+    assert entries["static"]["analysis"] is None
+    assert "analysis" in json.loads((folder / MACRO_INDEX_FILE).read_text())["heat"]
+
+
+def test_database_is_upgraded(tmp_path):
+    path = str(tmp_path / "macros.db")
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        """
+        CREATE TABLE macros (
+            command TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            refs TEXT NOT NULL,
+            static INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1
+        );
+        PRAGMA user_version=1;
+        """
+    )
+    for command, content in MACROS.items():
+        entry = index_entry(content, 0, None)
+        connection.execute(
+            "INSERT INTO macros (command, content, size, mtime, hash, refs, static) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                command,
+                content,
+                len(content),
+                0,
+                entry["hash"],
+                json.dumps(entry["references"]),
+                entry["static"],
+            ),
+        )
+    connection.commit()
+    connection.close()
+
+    storage = SqliteStorage(path)
+    entries = storage.load(MACROS)
+    storage.close()
+    for command, content in MACROS.items():
+        assert entries[command]["analysis"] == index_entry(content, 0, None)["analysis"]
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        create_storage("tape", str(tmp_path))
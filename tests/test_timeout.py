@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    plugin = make_plugin(preload_threads=0, render_timeout=0.2)
+    plugin.save_macros(
+        [
+            {
+                "command": "slow",
+                "content": "{% do wait() %}G4 P{{ params.P|default(0) }}",
+                "description": "",
+            },
+            {"command": "fast", "content": "G1 X{{ params.X }}", "description": ""},
+        ]
+    )
+    return plugin
+
+
+def test_slow_render_times_out(plugin):
+    release = threading.Event()
+    plugin.jinja_env.globals["wait"] = lambda: release.wait(10)
+    try:
+        assert plugin.render_macro("@slow") is None
+
+        message = plugin._plugin_manager.messages[-1]
+        assert message["type"] == "rendering_error"
+        assert message["command"] == "slow"
+        assert "0.2s" in message["reason"]
+
+        # Rendered on a fresh worker while the stuck one is still waiting
+        assert plugin.render_macro("@fast X=10") == ["G1 X10"]
+    finally:
+        # Let the abandoned render finish
+        release.set()
+
+    assert plugin.render_macro("@slow P=5") == ["G4 P5"]
+    assert len(plugin._plugin_manager.messages) == 1
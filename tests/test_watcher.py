@@ -0,0 +1,83 @@
+import queue
+import time
+
+import pytest
+
+from octoprint_gcode_macro import watcher
+from octoprint_gcode_macro.files import TEMP_SUFFIX
+from octoprint_gcode_macro.watcher import FileWatcher
+
+
+@pytest.fixture(params=["inotify", "polling"])
+def mode(request, monkeypatch):
+    monkeypatch.setattr(watcher, "DEBOUNCE_DELAY", 0.1)
+    monkeypatch.setattr(watcher, "POLL_INTERVAL", 0.1)
+    if request.param == "polling":
+        monkeypatch.setattr(watcher, "Observer", None)
+    elif watcher.Observer is None:
+        pytest.skip("watchdog is not installed")
+    return request.param
+
+
+def wait_for(check, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.05)
+    return check()
+
+
+def test_changes_are_reported_in_batches(tmp_path, mode):
+    (tmp_path / "ignored").mkdir()
+    (tmp_path / "sub").mkdir()
+    batches = queue.Queue()
+    files = FileWatcher(str(tmp_path), batches.put, ignore=("ignored/",))
+    files.start()
+    try:
+        assert files.polling == (mode == "polling")
+        # Polling only starts comparing once it has scanned the folder
+        time.sleep(0.2)
+
+        (tmp_path / "a.gcode").write_text("G28")
+        (tmp_path / "sub" / "b.j2").write_text("G29")
+        (tmp_path / ".hidden").write_text("")
+        (tmp_path / f"c.gcode{TEMP_SUFFIX}").write_text("")
+        (tmp_path / "ignored" / "d").write_text("")
+
+        assert batches.get(timeout=5) == {"a.gcode", "sub/b.j2"}
+
+        (tmp_path / "a.gcode").unlink()
+        assert batches.get(timeout=5) == {"a.gcode"}
+    finally:
+        files.stop()
+    assert batches.empty()
+
+
+def test_changed_files_are_reloaded(make_plugin, mode):
+    plugin = make_plugin(preload_threads=0, watch_files=True)
+    assert plugin.watcher.polling == (mode == "polling")
+    plugin.save_macros(
+        [
+            {"command": "park", "content": "G1 Z10", "description": ""},
+            {
+                "command": "start",
+                "content": '{% include "start.j2" %}\n@park',
+                "description": "",
+            },
+        ]
+    )
+    data = plugin._data_folder
+    with open(f"{data}/start.j2", "w") as f:
+        f.write("G28")
+    assert plugin.render_macro("@start") == ["G28", "G1 Z10"]
+    time.sleep(0.3)
+
+    with open(plugin.storage.get_path("park"), "w") as f:
+        f.write("G1 Z20 F600")
+    assert wait_for(lambda: plugin.render_macro("@start") == ["G28", "G1 Z20 F600"])
+
+    with open(f"{data}/start.j2", "w") as f:
+        f.write("G28 X Y")
+    assert wait_for(lambda: plugin.render_macro("@start") == ["G28 X Y", "G1 Z20 F600"])